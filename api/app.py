@@ -1,83 +1,2836 @@
 import os
 import io
+import sys
 import csv
+import json
+import hmac
+import marshal
+import pstats
+import cProfile
+import logging
+import sqlite3
+import urllib.parse
+import urllib.request
+import asyncio
+import time
+import hashlib
+import tempfile
+import re
+import uuid
+import zipfile
+import zlib
+from array import array
+from datetime import datetime, timezone
+from xml.sax.saxutils import escape as xml_escape
+import threading
+import multiprocessing
+from collections import OrderedDict, deque
+from contextvars import ContextVar
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import asynccontextmanager, contextmanager, nullcontext
 from fastapi import FastAPI, HTTPException, Request, Response
-from reportlab.platypus import SimpleDocTemplate, Paragraph
-from reportlab.lib.styles import getSampleStyleSheet
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Preformatted, Table, TableStyle
+from reportlab.platypus.paraparser import ParaFrag
+from reportlab.lib import colors
+from reportlab.lib.fonts import ps2tt, tt2ps
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.pagesizes import letter
+from reportlab.lib.units import inch
+from reportlab.pdfbase import pdfmetrics
+from reportlab.lib.rl_accel import escapePDF, fp_str
+from reportlab.pdfgen.canvas import Canvas
 from docx import Document
+from docx.opc.pkgwriter import PackageWriter
+from docx.shared import Emu
+import docx
+import reportlab
+
+logger = logging.getLogger("mca-export-worker")
 
-app = FastAPI()
 PY_WORKER_KEY = os.getenv("PY_WORKER_KEY", "")
+PY_WORKER_KEYS = os.getenv("PY_WORKER_KEYS", "")
+PY_ADMIN_KEY = os.getenv("PY_ADMIN_KEY", "")
+RENDER_POOL = os.getenv("RENDER_POOL", "thread").lower()
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", "0")) or (os.cpu_count() or 1)
+RENDER_MAX_CONCURRENCY = int(os.getenv("RENDER_MAX_CONCURRENCY", "0")) or RENDER_WORKERS
+RENDER_FAST_LANE_COST = float(os.getenv("RENDER_FAST_LANE_COST", str(256 << 10)))
+RENDER_FAST_LANE_SLOTS = int(os.getenv("RENDER_FAST_LANE_SLOTS", "0")) or max(1, RENDER_MAX_CONCURRENCY // 4)
+RENDER_TENANT_CONCURRENCY = int(os.getenv("RENDER_TENANT_CONCURRENCY", "0"))
+RENDER_MAX_QUEUED = int(os.getenv("RENDER_MAX_QUEUED", str(8 * RENDER_MAX_CONCURRENCY)))
+RENDER_TENANT_MAX_QUEUED = int(os.getenv("RENDER_TENANT_MAX_QUEUED", "0"))
+MAX_CONTENT_BYTES = int(os.getenv("MAX_CONTENT_BYTES", "0"))
+RETRY_AFTER_SECONDS = int(os.getenv("RETRY_AFTER_SECONDS", "2"))
+RENDER_MP_START = os.getenv("RENDER_MP_START", "") or (
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+CSV_STREAM_THRESHOLD = int(os.getenv("CSV_STREAM_THRESHOLD", str(1 << 20)))
+CSV_STREAM_CHUNK = int(os.getenv("CSV_STREAM_CHUNK", str(64 << 10)))
+RENDER_STREAM_QUEUE = int(os.getenv("RENDER_STREAM_QUEUE", "16"))
+STREAM_CACHE_BYTES = int(os.getenv("STREAM_CACHE_BYTES", str(1 << 20)))
+RENDER_CACHE_BYTES = int(os.getenv("RENDER_CACHE_BYTES", str(64 << 20)))
+RENDER_CACHE_DIR = os.getenv("RENDER_CACHE_DIR", "")
+RENDER_CACHE_DIR_BYTES = int(os.getenv("RENDER_CACHE_DIR_BYTES", str(1 << 30)))
+RENDER_CACHE_TTL = float(os.getenv("RENDER_CACHE_TTL", "0"))
+OFFLOAD_SIZE = 1 << 20
+CACHE_KEY_SLICE = 1 << 20
+# Exports are stamped with SOURCE_DATE_EPOCH (the reproducible-builds
+# convention) instead of the wall clock, so identical input always renders
+# to identical bytes and the input-derived ETag stays truthful.
+EXPORT_TIMESTAMP = datetime.fromtimestamp(int(os.getenv("SOURCE_DATE_EPOCH", "946684800")), timezone.utc).replace(tzinfo=None)
+EXPORT_ZIP_DATE_TIME = max(EXPORT_TIMESTAMP, datetime(1980, 1, 1)).timetuple()[:6]
+RENDERER_VERSION = f"2/reportlab-{reportlab.Version}/python-docx-{docx.__version__}"
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "500"))
+JOBS_DB = os.getenv("JOBS_DB", "")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "0")) or RENDER_WORKERS
+JOB_MAX_QUEUED = int(os.getenv("JOB_MAX_QUEUED", "0"))
+JOB_TTL = float(os.getenv("JOB_TTL", "3600"))
+JOB_CALLBACK_TIMEOUT = float(os.getenv("JOB_CALLBACK_TIMEOUT", "10"))
+# Hosts job callbacks may be sent to, comma-separated; ".example.com" also
+# allows its subdomains. Empty (the default) turns callback_url off, so
+# tenants cannot make the worker POST to internal addresses.
+JOB_CALLBACK_HOSTS = tuple(h.strip().lower() for h in os.getenv("JOB_CALLBACK_HOSTS", "").split(",") if h.strip())
+JOB_LEASE = float(os.getenv("JOB_LEASE", "60"))
+TRACE_SINKS = tuple(sink.strip() for sink in os.getenv("TRACE_SINKS", "ring").split(",") if sink.strip())
+TRACE_RING_SIZE = int(os.getenv("TRACE_RING_SIZE", "200"))
+TRACE_OTLP_PATH = os.getenv("TRACE_OTLP_PATH", "")
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "20"))
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.005"))
+PROFILE_MODES = ("cprofile", "sample")
+PDF_MODE = os.getenv("PDF_MODE", "auto").lower()
+PDF_MODES = ("auto", "fast", "platypus", "stream")
+# "text" renders content literally; "markup" passes it to ReportLab's
+# Paragraph mini-HTML parser as before; "markdown" is tokenized once into
+# headings, lists, code blocks and tables (see markdown_blocks()).
+CONTENT_FORMATS = ("text", "markup", "markdown")
+DOCX_WRITER = os.getenv("DOCX_WRITER", "stream").lower()
+DOCX_STREAM_CHUNK = int(os.getenv("DOCX_STREAM_CHUNK", str(64 << 10)))
+NDJSON_MEDIA_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl")
+
+EXPORT_TYPES = {
+    "pdf": ("application/pdf", "solace-export.pdf"),
+    "docx": ("application/vnd.openxmlformats-officedocument.wordprocessingml.document", "solace-export.docx"),
+    "csv": ("text/csv", "solace-export.csv"),
+}
+# Relative render cost per input character; each line also costs as much as
+# ~200 characters for the per-paragraph object and layout overhead.
+RENDER_COST_WEIGHTS = {"pdf": 1.0, "docx": 0.5, "csv": 0.05}
+RENDER_COST_PER_LINE = 200
+
+def _load_api_keys() -> dict:
+    keys = {}
+    if PY_WORKER_KEY:
+        keys[PY_WORKER_KEY] = "default"
+    for entry in PY_WORKER_KEYS.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        tenant, sep, key = entry.partition(":")
+        if not sep or not tenant.strip() or not key.strip():
+            raise ValueError("PY_WORKER_KEYS entries must look like tenant:key")
+        keys[key.strip()] = tenant.strip()
+    return keys
+
+API_KEYS = _load_api_keys()
+
+class ExportContent:
+    # Parsed once per request and shared by every renderer. The content is
+    # kept as the one string it arrived as; CSV, the cache key and the job
+    # store walk it with iter_lines() instead of holding a list of lines.
+    # `paragraphs` (the stripped, non-empty view) and `blocks` are only
+    # built, on first use, by the PDF/DOCX renderers that need them.
+    __slots__ = ("text", "size", "pdf_mode", "format", "_paragraphs", "_blocks")
+
+    def __init__(self, text: str, pdf_mode: str = PDF_MODE, format: str = "text"):
+        self.text = text
+        self.size = len(text)
+        self.pdf_mode = pdf_mode
+        self.format = format
+        self._paragraphs = None
+        self._blocks = None
+
+    def iter_lines(self):
+        text = self.text
+        start = 0
+        while True:
+            end = text.find("\n", start)
+            if end < 0:
+                yield text[start:]
+                return
+            yield text[start:end]
+            start = end + 1
+
+    def line_count(self) -> int:
+        return self.text.count("\n") + 1
+
+    @property
+    def paragraphs(self) -> list:
+        if self._paragraphs is None:
+            self._paragraphs = [p for p in map(str.strip, self.iter_lines()) if p]
+        return self._paragraphs
+
+    @property
+    def blocks(self) -> list:
+        if self._blocks is None:
+            self._blocks = markdown_blocks(self.text.split("\n"))
+        return self._blocks
+
+class Trace:
+    # Timing spans for one request or one render. Each span may name a
+    # metrics phase; the phase is credited with the span's self time (its
+    # duration minus nested spans), so nested spans are never counted twice.
+    __slots__ = ("trace_id", "name", "spans", "phases", "_stack")
+
+    def __init__(self, name: str = "", trace_id: str = None):
+        self.trace_id = trace_id or os.urandom(16).hex()
+        self.name = name
+        self.spans = []
+        self.phases = {}
+        self._stack = []
+
+    def add_phase(self, phase: str, seconds: float):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    @contextmanager
+    def span(self, name: str, phase: str = None, **attrs):
+        span_id = os.urandom(8).hex()
+        parent_id = self._stack[-1][0] if self._stack else None
+        frame = [span_id, 0.0]
+        self._stack.append(frame)
+        start_ns = time.time_ns()
+        start = time.perf_counter()
+        try:
+            yield attrs
+        finally:
+            duration = time.perf_counter() - start
+            self._stack.pop()
+            if self._stack:
+                self._stack[-1][1] += duration
+            if phase:
+                self.add_phase(phase, duration - frame[1])
+            self.spans.append({
+                "name": name,
+                "span_id": span_id,
+                "parent_id": parent_id,
+                "start_ns": start_ns,
+                "duration": duration,
+                "phase": phase,
+                "attrs": attrs,
+            })
+
+    def adopt(self, spans: list, phases: dict):
+        parent_id = self._stack[-1][0] if self._stack else None
+        for span in spans:
+            if span["parent_id"] is None:
+                span["parent_id"] = parent_id
+            self.spans.append(span)
+        for phase, seconds in phases.items():
+            self.add_phase(phase, seconds)
+
+current_trace = ContextVar("current_trace", default=None)
+trace_ring = deque(maxlen=TRACE_RING_SIZE)
+
+if set(TRACE_SINKS) - {"ring", "log", "otlp"}:
+    raise ValueError(f"Unknown TRACE_SINKS entry in {TRACE_SINKS}; expected ring, log or otlp")
+
+def traced(name: str, phase: str = None, **attrs):
+    trace = current_trace.get()
+    return trace.span(name, phase, **attrs) if trace is not None else nullcontext(attrs)
+
+def trace_summary(trace: Trace) -> dict:
+    spans = sorted(trace.spans, key=lambda span: span["start_ns"])
+    return {
+        "trace_id": trace.trace_id,
+        "name": trace.name,
+        "start_ns": spans[0]["start_ns"] if spans else None,
+        "duration_ms": round(max((span["duration"] for span in spans), default=0.0) * 1000, 3),
+        "phases_ms": {phase: round(seconds * 1000, 3) for phase, seconds in trace.phases.items()},
+        "spans": [
+            {
+                "name": span["name"],
+                "span_id": span["span_id"],
+                "parent_id": span["parent_id"],
+                "offset_ms": round((span["start_ns"] - spans[0]["start_ns"]) / 1e6, 3),
+                "duration_ms": round(span["duration"] * 1000, 3),
+                "phase": span["phase"],
+                "attrs": span["attrs"],
+            }
+            for span in spans
+        ],
+    }
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+def trace_to_otlp(trace: Trace) -> dict:
+    spans = []
+    for span in trace.spans:
+        attrs = dict(span["attrs"])
+        if span["phase"]:
+            attrs["export.phase"] = span["phase"]
+        spans.append({
+            "traceId": trace.trace_id,
+            "spanId": span["span_id"],
+            "parentSpanId": span["parent_id"] or "",
+            "name": span["name"],
+            "kind": 1,
+            "startTimeUnixNano": str(span["start_ns"]),
+            "endTimeUnixNano": str(span["start_ns"] + int(span["duration"] * 1e9)),
+            "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in attrs.items()],
+        })
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": "mca-export-worker"}}]},
+            "scopeSpans": [{"scope": {"name": "mca-export-worker"}, "spans": spans}],
+        }]
+    }
+
+def emit_trace(trace: Trace):
+    for sink in TRACE_SINKS:
+        if sink == "ring":
+            trace_ring.append(trace_summary(trace))
+        elif sink == "log":
+            summary = trace_summary(trace)
+            phases = " ".join(f"{phase}={ms}ms" for phase, ms in summary["phases_ms"].items())
+            logger.info("trace %s %s %sms %s", trace.trace_id, trace.name, summary["duration_ms"], phases)
+        elif sink == "otlp":
+            line = json.dumps(trace_to_otlp(trace), separators=(",", ":"))
+            if TRACE_OTLP_PATH:
+                with open(TRACE_OTLP_PATH, "a", encoding="utf-8") as f:
+                    f.write(line + "\n")
+            else:
+                logger.info("%s", line)
+
+class _TracedCanvas(Canvas):
+    # doc.build() lays out and then writes the file from inside
+    # canvas.save(); a span around save() separates serialization from
+    # layout.
+    def __init__(self, *args, trace: Trace, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._trace = trace
+
+    def save(self):
+        with self._trace.span("canvas.save", phase="serialize"):
+            super().save()
+
+# Markdown: one pass over the lines into (kind, level, value) blocks, which
+# both renderers walk. Kinds are "heading" (level 1-6), "paragraph",
+# "bullet"/"number" (list items, level 0-2 by nesting), "code" (value is
+# the verbatim text) and "table" (value is a list of rows of cell text, the
+# header first, every row padded to the header's width). Text values keep
+# their inline markup; markdown_spans() splits it into runs when rendered.
+# Thematic breaks are dropped; anything else is paragraph text.
+_MD_FENCE = re.compile(r" {0,3}(`{3,}|~{3,})")
+_MD_HEADING = re.compile(r" {0,3}(#{1,6})(?:[ \t]+(.*?))?(?:[ \t]+#+)?[ \t]*$")
+_MD_RULE = re.compile(r" {0,3}([-*_])(?:[ \t]*\1){2,}[ \t]*$")
+_MD_LIST_ITEM = re.compile(r"( *)(?:[-*+]|(\d{1,9})[.)])(?:[ \t]+(.*))?$")
+_MD_TABLE_RULE = re.compile(r" {0,3}\|?[ \t]*:?-+:?[ \t]*(?:\|[ \t]*:?-+:?[ \t]*)*\|?[ \t]*$")
+_MD_CELL_SPLIT = re.compile(r"(?<!\\)\|")
+MARKDOWN_MAX_LIST_DEPTH = 3
+
+def _markdown_cells(line: str) -> list:
+    line = line.strip()
+    if line.startswith("|"):
+        line = line[1:]
+    if line.endswith("|") and not line.endswith("\\|"):
+        line = line[:-1]
+    return [cell.strip().replace("\\|", "|") for cell in _MD_CELL_SPLIT.split(line)]
+
+def markdown_blocks(lines) -> list:
+    blocks = []
+    para = []
+    para_kind = para_level = None
+    indents = []
+    fence = None
+    code = []
+    n = len(lines)
+    i = 0
+    while i < n:
+        line = lines[i].rstrip("\r")
+        i += 1
+        if fence is not None:
+            stripped = line.strip()
+            if stripped.startswith(fence) and not stripped.strip(fence[0]):
+                blocks.append(("code", 0, "\n".join(code)))
+                fence = None
+                code = []
+            else:
+                code.append(line)
+            continue
+        if not line.strip():
+            if para:
+                blocks.append((para_kind, para_level, " ".join(para)))
+                para = []
+            continue
+        m = _MD_LIST_ITEM.match(line.expandtabs(4))
+        block_start = m is not None or _MD_FENCE.match(line) or _MD_HEADING.match(line) or _MD_RULE.match(line) or (
+            "|" in line and i < n and _MD_TABLE_RULE.match(lines[i].rstrip("\r"))
+            and len(_markdown_cells(lines[i])) == len(_markdown_cells(line))
+        )
+        if not block_start:
+            if not para:
+                para_kind, para_level = "paragraph", 0
+                indents.clear()
+            para.append(line.strip())
+            continue
+        if para:
+            blocks.append((para_kind, para_level, " ".join(para)))
+            para = []
+        if m is not None and not _MD_RULE.match(line):
+            indent = len(m.group(1))
+            while indents and indents[-1] > indent:
+                indents.pop()
+            if not indents or indents[-1] < indent:
+                indents.append(indent)
+            para_kind = "bullet" if m.group(2) is None else "number"
+            para_level = min(len(indents), MARKDOWN_MAX_LIST_DEPTH) - 1
+            para.append((m.group(3) or "").strip())
+            continue
+        indents.clear()
+        fm = _MD_FENCE.match(line)
+        if fm:
+            fence = fm.group(1)
+            continue
+        hm = _MD_HEADING.match(line)
+        if hm:
+            blocks.append(("heading", len(hm.group(1)), hm.group(2) or ""))
+            continue
+        if _MD_RULE.match(line):
+            continue
+        header = _markdown_cells(line)
+        rows = [header]
+        i += 1
+        while i < n and "|" in lines[i] and lines[i].strip():
+            cells = _markdown_cells(lines[i].rstrip("\r"))
+            rows.append((cells + [""] * len(header))[:len(header)])
+            i += 1
+        blocks.append(("table", 0, rows))
+    if fence is not None:
+        blocks.append(("code", 0, "\n".join(code)))
+    elif para:
+        blocks.append((para_kind, para_level, " ".join(para)))
+    return blocks
+
+# Inline markup inside block text: backslash escapes, `code`, **bold** /
+# __bold__ and *italic* / _italic_, without nesting. Spans are (text, kind)
+# pairs with kind "", "b", "i" or "code"; adjacent plain text is merged.
+_MD_INLINE = re.compile(
+    r"\\([!-/:-@\[-`{-~])"
+    r"|(`+)(.+?)\2"
+    r"|\*\*(?=\S)(.+?)(?<=\S)\*\*|(?<!\w)__(?=\S)(.+?)(?<=\S)__(?!\w)"
+    r"|\*(?=\S)(.+?)(?<=\S)\*|(?<!\w)_(?=\S)(.+?)(?<=\S)_(?!\w)"
+)
+
+def markdown_spans(text: str) -> list:
+    spans = []
+
+    def add(piece: str, kind: str):
+        if not piece:
+            return
+        if spans and spans[-1][1] == kind:
+            spans[-1] = (spans[-1][0] + piece, kind)
+        else:
+            spans.append((piece, kind))
+
+    pos = 0
+    for m in _MD_INLINE.finditer(text):
+        add(text[pos:m.start()], "")
+        pos = m.end()
+        escaped, _, code, bold, bold2, italic, italic2 = m.groups()
+        if escaped is not None:
+            add(escaped, "")
+        elif code is not None:
+            if len(code) > 2 and code[0] == code[-1] == " " and code.strip():
+                code = code[1:-1]
+            add(code, "code")
+        elif bold is not None or bold2 is not None:
+            add(bold or bold2, "b")
+        else:
+            add(italic or italic2, "i")
+    add(text[pos:], "")
+    return spans
+
+def markdown_table_spans(rows: list) -> list:
+    # Header cells are bold in both renderers.
+    header = [[(text, kind or "b") for text, kind in markdown_spans(cell)] for cell in rows[0]]
+    return [header] + [[markdown_spans(cell) for cell in row] for row in rows[1:]]
+
+_pdf_styles = None
+_pdf_styles_lock = threading.Lock()
+
+def pdf_styles():
+    # getSampleStyleSheet() builds a fresh set of ParagraphStyle objects on
+    # every call. Build it once per process and share it: Paragraph only
+    # reads its style, so the shared instances are safe across threads as
+    # long as nothing mutates them after this point. The markdown styles
+    # are added here too.
+    global _pdf_styles
+    if _pdf_styles is None:
+        with _pdf_styles_lock:
+            if _pdf_styles is None:
+                styles = getSampleStyleSheet()
+                for level in range(MARKDOWN_MAX_LIST_DEPTH):
+                    styles.add(ParagraphStyle(
+                        f"ListItem{level + 1}", parent=styles["Bullet"],
+                        leftIndent=24 * (level + 1), bulletIndent=24 * level + 6,
+                    ))
+                styles.add(ParagraphStyle("CodeBlock", parent=styles["Code"], spaceBefore=6, spaceAfter=6))
+                styles.add(ParagraphStyle("TableCell", parent=styles["BodyText"], spaceBefore=0))
+                _pdf_styles = styles
+    return _pdf_styles
 
 def generate_pdf(title: str, text: str) -> bytes:
+    return build_pdf(title, ExportContent(text))
+
+def build_pdf(title: str, content: ExportContent, trace: Trace = None) -> bytes:
+    trace = trace or Trace()
+    # Builds the cached view the writers below read.
+    with trace.span("content.split", phase="parse"):
+        content.blocks if content.format == "markdown" else content.paragraphs
+    if content.pdf_mode == "stream":
+        with trace.span("stream.write", phase="layout") as attrs:
+            data = b"".join(iter_pdf_stream(title, content))
+            attrs["paragraphs"] = len(content.paragraphs) + 1
+        return data
+    markup = content.format == "markup"
+    if content.pdf_mode == "fast" or (content.pdf_mode == "auto" and pdf_fast_path_ok(title, content.paragraphs, markup)):
+        return build_pdf_fast(title, content, trace)
     buf = io.BytesIO()
-    doc = SimpleDocTemplate(buf, pagesize=letter)
-    styles = getSampleStyleSheet()
-    story = [Paragraph(f"<b>{title}</b>", styles["Heading1"])]
-    for para in text.split("\n"):
-        para = para.strip()
-        if not para:
-            continue
-        story.append(Paragraph(para, styles["BodyText"]))
-    doc.build(story)
+    doc = SimpleDocTemplate(buf, pagesize=letter, invariant=1)
+    with trace.span("paragraphs.build", phase="layout") as attrs:
+        styles = pdf_styles()
+        if markup:
+            story = [Paragraph(f"<b>{xml_escape(title)}</b>", styles["Heading1"])]
+            body_style = styles["BodyText"]
+            for para in content.paragraphs:
+                story.append(Paragraph(para, body_style))
+        else:
+            story = [PlainParagraphs(styles["Heading1"])(title)]
+            if content.format == "markdown":
+                story.extend(markdown_flowables(content.blocks))
+            else:
+                body = PlainParagraphs(styles["BodyText"])
+                story.extend(map(body, content.paragraphs))
+        attrs["paragraphs"] = len(story)
+    with trace.span("doc.build", phase="layout"):
+        doc.build(story, canvasmaker=lambda *args, **kwargs: _TracedCanvas(*args, trace=trace, **kwargs))
     return buf.getvalue()
 
-def generate_docx(title: str, text: str) -> bytes:
-    doc = Document()
-    doc.add_heading(title, level=1)
-    for para in text.split("\n"):
-        para = para.strip()
-        if not para:
+class PlainParagraphs:
+    # Paragraphs for literal text, built from fragments made here instead
+    # of running Paragraph's markup parser, so "<" and "&" are just
+    # characters. Each fragment carries what the parser would set for text
+    # in the style's font, or its bold/italic/Courier variant for markdown
+    # spans; identical text shares one fragment list, which Paragraph only
+    # reads.
+    def __init__(self, style):
+        self.style = style
+        self.family, self.bold, self.italic = ps2tt(style.fontName)
+        self._frags = {}
+
+    def _frag(self, text: str, kind: str = "") -> ParaFrag:
+        family, bold, italic = self.family, self.bold, self.italic
+        if kind == "code":
+            family = "courier"
+        elif kind == "b":
+            bold = 1
+        elif kind == "i":
+            italic = 1
+        frag = ParaFrag()
+        frag.rise = 0
+        frag.greek = 0
+        frag.link = []
+        frag.fontName = tt2ps(family, bold, italic)
+        frag.bold = bold
+        frag.italic = italic
+        frag.fontSize = self.style.fontSize
+        frag.textColor = self.style.textColor
+        frag.us_lines = []
+        frag.text = text
+        return frag
+
+    def __call__(self, text: str) -> Paragraph:
+        frags = self._frags.get(text)
+        if frags is None:
+            frags = self._frags[text] = [self._frag(text)]
+        return Paragraph(text, self.style, frags=frags)
+
+    def spans(self, spans: list, bullet: str = None) -> Paragraph:
+        key = tuple(spans)
+        frags = self._frags.get(key)
+        if frags is None:
+            frags = self._frags[key] = [self._frag(text, kind) for text, kind in spans] or [self._frag("")]
+        return Paragraph("".join(text for text, _ in spans), self.style, bulletText=bullet, frags=frags)
+
+def markdown_flowables(blocks: list) -> list:
+    styles = pdf_styles()
+    cache = {}
+
+    def paragraphs(style_name: str) -> PlainParagraphs:
+        made = cache.get(style_name)
+        if made is None:
+            made = cache[style_name] = PlainParagraphs(styles[style_name])
+        return made
+
+    code_style = styles["CodeBlock"]
+    code_columns = int((PDF_FRAME_WIDTH - code_style.leftIndent - code_style.rightIndent)
+                       // pdfmetrics.stringWidth(" ", code_style.fontName, code_style.fontSize))
+    story = []
+    numbers = [0] * MARKDOWN_MAX_LIST_DEPTH
+    for kind, level, value in blocks:
+        if kind == "number":
+            numbers[level] += 1
+            numbers[level + 1:] = [0] * (MARKDOWN_MAX_LIST_DEPTH - level - 1)
+            story.append(paragraphs(f"ListItem{level + 1}").spans(markdown_spans(value), f"{numbers[level]}."))
+            continue
+        if kind == "bullet":
+            numbers[level:] = [0] * (MARKDOWN_MAX_LIST_DEPTH - level)
+            story.append(paragraphs(f"ListItem{level + 1}").spans(markdown_spans(value), "\u2022"))
+            continue
+        numbers = [0] * MARKDOWN_MAX_LIST_DEPTH
+        if kind == "heading":
+            story.append(paragraphs(f"Heading{level}").spans(markdown_spans(value)))
+        elif kind == "paragraph":
+            story.append(paragraphs("BodyText").spans(markdown_spans(value)))
+        elif kind == "code":
+            story.append(Preformatted(value.expandtabs(4), code_style, maxLineLength=code_columns))
+        elif kind == "table":
+            cell = paragraphs("TableCell")
+            rows = [[cell.spans(spans) for spans in row] for row in markdown_table_spans(value)]
+            columns = len(value[0])
+            story.append(Table(rows, colWidths=[PDF_FRAME_WIDTH / columns] * columns, repeatRows=1, splitInRow=1, style=TableStyle([
+                ("GRID", (0, 0), (-1, -1), 0.5, colors.grey),
+                ("VALIGN", (0, 0), (-1, -1), "TOP"),
+            ])))
+    return story
+
+# Fast path for plain text: the same page as build_pdf() (letter, 1 inch
+# margins, the frame's 6pt padding, Heading1 title, BodyText paragraphs),
+# laid out directly instead of through Paragraph/Frame. The wrapping and
+# page-splitting rules below follow what platypus does for a single-font
+# left-aligned paragraph, so for text without markup both paths produce
+# the same PDF. Soft hyphens and the non-breaking spaces Paragraph treats
+# specially, and markup in "markup" content, go through platypus in auto
+# mode.
+PDF_FRAME_PADDING = 6
+PDF_FRAME_LEFT = inch + PDF_FRAME_PADDING
+PDF_FRAME_TOP = letter[1] - inch - PDF_FRAME_PADDING
+PDF_FRAME_BOTTOM = inch + PDF_FRAME_PADDING
+PDF_FRAME_WIDTH = letter[0] - 2 * PDF_FRAME_LEFT
+_PDF_PLATYPUS_ONLY = re.compile("[\xa0\xad\u200b]")
+_PDF_PLATYPUS_ONLY_MARKUP = re.compile("[<&\xa0\xad\u200b]")
+
+def pdf_fast_path_ok(title: str, paragraphs: list, markup: bool = False) -> bool:
+    search = (_PDF_PLATYPUS_ONLY_MARKUP if markup else _PDF_PLATYPUS_ONLY).search
+    if not title.strip() or search(title):
+        return False
+    return not any(search(para) for para in paragraphs)
+
+class _WordPiece(str):
+    # Part of a word wrap_words() cut to fit; the last part is a _WordEnd.
+    pass
+
+class _WordEnd(_WordPiece):
+    pass
+
+def _unwrap_words(lines):
+    # The words of wrapped lines with cut words joined back together, as
+    # Paragraph.split hands them to each half.
+    pieces = []
+    for _, words in lines:
+        for word in words:
+            if isinstance(word, _WordPiece):
+                pieces.append(word)
+                if isinstance(word, _WordEnd):
+                    yield "".join(pieces)
+                    pieces.clear()
+                continue
+            if pieces:
+                yield "".join(pieces)
+                pieces.clear()
+            yield word
+    if pieces:
+        yield "".join(pieces)
+
+class GlyphWidths:
+    # A standard font's glyph widths (1/1000 em) as an array indexed by the
+    # byte its encoding gives each character. Built once per font and
+    # process; units() sums them the way stringWidth() does, falling back
+    # to the substitution fonts for characters the font cannot encode.
+    __slots__ = ("fonts", "encoding", "widths")
+
+    def __init__(self, font_name: str):
+        font = pdfmetrics.getFont(font_name)
+        self.fonts = [font] + font.substitutionFonts
+        self.encoding = font.encName
+        self.widths = array("H", font.widths)
+
+    def units(self, text: str) -> int:
+        try:
+            return sum(map(self.widths.__getitem__, text.encode(self.encoding)))
+        except UnicodeEncodeError:
+            return sum(sum(map(f.widths.__getitem__, t)) for f, t in pdfmetrics.unicode2T1(text, self.fonts))
+
+_glyph_widths = {}
+
+def glyph_widths(font_name: str) -> GlyphWidths:
+    glyphs = _glyph_widths.get(font_name)
+    if glyphs is None:
+        glyphs = _glyph_widths.setdefault(font_name, GlyphWidths(font_name))
+    return glyphs
+
+class WordWidths:
+    # Point widths of one document's words in one font and size. Natural
+    # text repeats most of its words, so each distinct word is measured
+    # once per document; the results match stringWidth() exactly.
+    __slots__ = ("glyphs", "size", "memo")
+
+    def __init__(self, font_name: str, size: float):
+        self.glyphs = glyph_widths(font_name)
+        self.size = size
+        self.memo = {}
+
+    def __call__(self, word: str) -> float:
+        width = self.memo.get(word)
+        if width is None:
+            width = self.memo[word] = self.glyphs.units(word) * 0.001 * self.size
+        return width
+
+    def measure(self, words: list) -> list:
+        memo = self.memo
+        units = self.glyphs.units
+        size = self.size
+        widths = []
+        for word in words:
+            width = memo.get(word)
+            if width is None:
+                width = memo[word] = units(word) * 0.001 * size
+            widths.append(width)
+        return widths
+
+def wrap_words(words: list, measure: WordWidths, max_width: float, space_shrinkage: float) -> list:
+    # Greedy wrap as in Paragraph.breakLines: a line may run over by
+    # space_shrinkage of a space per word, and a word wider than the line
+    # is cut into pieces, the first of which ends its line. Returns
+    # (extra, words) pairs, extra being the unused width (negative when
+    # the line was shrunk).
+    space = measure(" ")
+    shrink = space_shrinkage * space
+    lines = []
+    line = []
+    width = -space
+    widths = measure.measure(words)
+    widths.reverse()
+    words = words[::-1]
+    forced = False
+    while words:
+        word = words.pop()
+        word_width = widths.pop()
+        new_width = width + space + word_width
+        limit = max_width + shrink * len(line)
+        if forced:
+            # The first piece of a cut word ends the current line.
+            forced = False
+            if word:
+                line.append(word)
+            lines.append((max_width - new_width, line))
+            line = []
+            width = -space
+            continue
+        if new_width > limit and word_width > max_width and not isinstance(word, _WordPiece):
+            cut = []
+            piece = ""
+            piece_width = width + space
+            for char in word:
+                char_width = measure(char)
+                if piece_width + char_width > max_width:
+                    cut.append(_WordPiece(piece))
+                    piece = ""
+                    piece_width = 0
+                piece += char
+                piece_width += char_width
+            cut.append(_WordEnd(piece))
+            words.extend(reversed(cut))
+            widths.extend(measure.measure(cut[::-1]))
+            forced = True
             continue
-        doc.add_paragraph(para)
+        if new_width <= limit or not line:
+            line.append(word)
+            width = new_width
+        else:
+            lines.append((max_width - width, line))
+            line = [word]
+            width = word_width
+    if line:
+        lines.append((max_width - width, line))
+    return lines
+
+def layout_plain_pdf(title: str, paragraphs, width: float = PDF_FRAME_WIDTH):
+    # Yields one page at a time as a list of (style, y, lines) blocks, y
+    # being the bottom of the block. Spacing follows Frame: spaceBefore is
+    # dropped at the top of a page and overlaps the previous spaceAfter,
+    # and a paragraph that does not fit is split across pages unless that
+    # would leave a single orphan line at the bottom.
+    styles = pdf_styles()
+    heading = styles["Heading1"]
+    body = styles["BodyText"]
+    measures = {style.name: WordWidths(style.fontName, style.fontSize) for style in (heading, body)}
+    page = []
+    y = PDF_FRAME_TOP
+    space_after = 0
+    at_top = True
+
+    def flows():
+        yield heading, title
+        for para in paragraphs:
+            yield body, para
+
+    for style, text in flows():
+        measure = measures[style.name]
+        wrap = lambda words: wrap_words(words, measure, width, style.spaceShrinkage)
+        lines = wrap(text.split())
+        leading = style.leading
+        while lines:
+            space = 0 if at_top else max(style.spaceBefore - space_after, 0)
+            height = len(lines) * leading
+            if y - space - height >= PDF_FRAME_BOTTOM - 1e-6:
+                y -= space + height
+                page.append((style, y, lines))
+                y -= style.spaceAfter
+                space_after = style.spaceAfter
+                at_top = False
+                break
+            available = y - PDF_FRAME_BOTTOM - space
+            fits = int(available / leading) if available >= 1e-6 else 0
+            if fits > 1:
+                # Like Paragraph.split, both halves are wrapped again
+                # from their words.
+                y -= space + fits * leading
+                page.append((style, y, wrap(list(_unwrap_words(lines[:fits])))))
+                lines = wrap(list(_unwrap_words(lines[fits:])))
+            elif at_top:
+                raise ValueError("Paragraph too tall for an empty page")
+            yield page
+            page = []
+            y = PDF_FRAME_TOP
+            space_after = 0
+            at_top = True
+    yield page
+
+def draw_plain_pdf_page(canvas: Canvas, page: list):
+    # Same operators Paragraph.drawOn emits for a left-aligned paragraph.
+    for style, y, lines in page:
+        canvas.saveState()
+        canvas.translate(PDF_FRAME_LEFT, y)
+        canvas.saveState()
+        canvas.setFillColor(style.textColor)
+        text = canvas.beginText(0, len(lines) * style.leading - style.fontSize)
+        text.setFont(style.fontName, style.fontSize, style.leading)
+        for extra, words in lines:
+            if extra < -1e-8 and len(words) > 1:
+                text.setWordSpace(extra / (len(words) - 1))
+                text.textLine(" ".join(words))
+                text.setWordSpace(0)
+            else:
+                text.textLine(" ".join(words))
+        canvas.drawText(text)
+        canvas.restoreState()
+        canvas.restoreState()
+
+def build_pdf_fast(title: str, content: ExportContent, trace: Trace) -> bytes:
     buf = io.BytesIO()
-    doc.save(buf)
+    canvas = _TracedCanvas(buf, pagesize=letter, invariant=1, trace=trace)
+    # The document info SimpleDocTemplate sets when none is given.
+    canvas.setAuthor(None)
+    canvas.setTitle(None)
+    canvas.setSubject(None)
+    canvas.setCreator(None)
+    canvas.setProducer(None)
+    canvas.setKeywords([])
+    with trace.span("fast.layout", phase="layout") as attrs:
+        pages = 0
+        for page in layout_plain_pdf(title, content.paragraphs):
+            draw_plain_pdf_page(canvas, page)
+            canvas.showPage()
+            pages += 1
+        attrs["paragraphs"] = len(content.paragraphs) + 1
+        attrs["pages"] = pages
+    canvas.save()
     return buf.getvalue()
 
-def generate_csv(text: str) -> bytes:
+class PdfStreamWriter:
+    # Writes a PDF front to back so it can be sent while it is being laid
+    # out: each page's content stream and page object go out as soon as the
+    # page is done, and the fonts, page tree, catalog, info, xref and
+    # trailer follow the last page. The catalog, page tree and shared
+    # resources get fixed object numbers up front so pages can refer to
+    # them before they are written. Only byte offsets and page references
+    # are kept, never page content.
+    CATALOG, PAGES, RESOURCES, INFO = 1, 2, 3, 4
+
+    def __init__(self, pagesize=letter):
+        self.pagesize = pagesize
+        self.offsets = [0] * self.INFO
+        self.position = 0
+        self.pages = []
+        self.fonts = {}
+        self._digest = hashlib.md5()
+
+    def _emit(self, data: bytes) -> bytes:
+        self.position += len(data)
+        self._digest.update(data)
+        return data
+
+    def _object(self, number: int, body: bytes) -> bytes:
+        self.offsets[number - 1] = self.position
+        return self._emit(b"%d 0 obj\n" % number + body + b"\nendobj\n")
+
+    def _new_object(self) -> int:
+        self.offsets.append(0)
+        return len(self.offsets)
+
+    def font_name(self, font) -> str:
+        name = self.fonts.get(font.fontName)
+        if name is None:
+            name = self.fonts[font.fontName] = f"/F{len(self.fonts) + 1}"
+        return name
+
+    def begin(self) -> bytes:
+        return self._emit(b"%PDF-1.4\n%\x93\x8c\x8b\x9e\n")
+
+    def page(self, stream: bytes) -> bytes:
+        data = zlib.compress(stream)
+        content = self._new_object()
+        page = self._new_object()
+        self.pages.append(page)
+        return self._object(content, b"<< /Filter /FlateDecode /Length %d >>\nstream\n" % len(data) + data + b"\nendstream") + self._object(
+            page,
+            b"<< /Type /Page /Parent %d 0 R /Resources %d 0 R /MediaBox [0 0 %s %s] /Contents %d 0 R >>"
+            % (self.PAGES, self.RESOURCES, fp_str(self.pagesize[0]).encode(), fp_str(self.pagesize[1]).encode(), content),
+        )
+
+    def end(self) -> bytes:
+        out = []
+        fonts = []
+        for font_name, name in self.fonts.items():
+            number = self._new_object()
+            encoding = pdfmetrics.getFont(font_name).encName
+            font = f"<< /Type /Font /Subtype /Type1 /BaseFont /{font_name} /Name {name}"
+            if encoding == "WinAnsiEncoding":
+                font += " /Encoding /WinAnsiEncoding"
+            out.append(self._object(number, (font + " >>").encode("ascii")))
+            fonts.append(f"{name} {number} 0 R")
+        out.append(self._object(self.RESOURCES, f"<< /Font << {' '.join(fonts)} >> /ProcSet [/PDF /Text] >>".encode("ascii")))
+        kids = " ".join(f"{page} 0 R" for page in self.pages)
+        out.append(self._object(self.PAGES, f"<< /Type /Pages /Count {len(self.pages)} /Kids [{kids}] >>".encode("ascii")))
+        out.append(self._object(self.CATALOG, b"<< /Type /Catalog /Pages %d 0 R >>" % self.PAGES))
+        date = EXPORT_TIMESTAMP.strftime("D:%Y%m%d%H%M%S+00'00'")
+        out.append(self._object(self.INFO, f"<< /Producer (mca-export-worker) /CreationDate ({date}) /ModDate ({date}) >>".encode("ascii")))
+        xref = self.position
+        file_id = self._digest.hexdigest()
+        table = [b"xref\n0 %d\n0000000000 65535 f \n" % (len(self.offsets) + 1)]
+        table.extend(b"%010d 00000 n \n" % offset for offset in self.offsets)
+        table.append(
+            b"trailer\n<< /Size %d /Root %d 0 R /Info %d 0 R /ID [<%s><%s>] >>\nstartxref\n%d\n%%%%EOF\n"
+            % (len(self.offsets) + 1, self.CATALOG, self.INFO, file_id.encode(), file_id.encode(), xref)
+        )
+        out.append(self._emit(b"".join(table)))
+        return b"".join(out)
+
+def plain_pdf_page_stream(writer: PdfStreamWriter, page: list) -> bytes:
+    # The operators draw_plain_pdf_page() gets from the canvas, written
+    # directly. Characters Helvetica cannot encode switch to the
+    # substitution fonts, as the canvas text object does.
+    out = []
+    for style, y, lines in page:
+        font = pdfmetrics.getFont(style.fontName)
+        fonts = [font] + font.substitutionFonts
+        size = fp_str(style.fontSize)
+        leading = fp_str(style.leading)
+        select = f"{writer.font_name(font)} {size} Tf {leading} TL"
+        out.append(
+            f"q\n1 0 0 1 {fp_str(PDF_FRAME_LEFT)} {fp_str(y)} cm\nq\n0 0 0 rg\n"
+            f"BT 1 0 0 1 0 {fp_str(len(lines) * style.leading - style.fontSize)} Tm {select}"
+        )
+        for extra, words in lines:
+            spaced = extra < -1e-8 and len(words) > 1
+            if spaced:
+                out.append(f" {fp_str(extra / (len(words) - 1))} Tw")
+            current = font
+            for run_font, run in pdfmetrics.unicode2T1(" ".join(words), fonts):
+                if run_font is not current:
+                    out.append(f" {writer.font_name(run_font)} {size} Tf {leading} TL")
+                    current = run_font
+                out.append(f" ({escapePDF(run)}) Tj")
+            if current is not font:
+                out.append(f" {select}")
+            out.append(" T*")
+            if spaced:
+                out.append(" 0 Tw")
+        out.append(" ET\nQ\nQ\n")
+    return "".join(out).encode("latin-1")
+
+def iter_pdf_stream(title: str, content: ExportContent):
+    # Same layout as the fast path, sent page by page.
+    writer = PdfStreamWriter()
+    # Helvetica is the canvas' initial font, so it is /F1 there too.
+    writer.font_name(pdfmetrics.getFont("Helvetica"))
+    yield writer.begin()
+    for page in layout_plain_pdf(title, content.paragraphs):
+        yield writer.page(plain_pdf_page_stream(writer, page))
+    yield writer.end()
+
+def generate_docx(title: str, text: str) -> bytes:
+    return build_docx(title, ExportContent(text))
+
+def build_docx(title: str, content: ExportContent, trace: Trace = None) -> bytes:
+    trace = trace or Trace()
+    markdown = content.format == "markdown"
+    with trace.span("content.split", phase="parse"):
+        body = content.blocks if markdown else content.paragraphs
+    if DOCX_WRITER != "document":
+        buf = io.BytesIO()
+        with trace.span("docx.stream", phase="serialize") as attrs:
+            stream_docx(title, markdown_docx_xml(body) if markdown else map(docx_paragraph_xml, body), buf)
+            attrs["paragraphs"] = len(body) + 1
+        return buf.getvalue()
+    with trace.span("paragraphs.build", phase="layout") as attrs:
+        doc = Document()
+        doc.add_heading(title, level=1)
+        if markdown:
+            add_markdown_docx(doc, body)
+        else:
+            for para in body:
+                doc.add_paragraph(para)
+        attrs["paragraphs"] = len(body) + 1
+    with trace.span("doc.save", phase="serialize"):
+        buf = io.BytesIO()
+        save_docx(doc, buf)
+    return buf.getvalue()
+
+def _docx_zip_info(membername: str) -> zipfile.ZipInfo:
+    info = zipfile.ZipInfo(membername, date_time=EXPORT_ZIP_DATE_TIME)
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.external_attr = 0o600 << 16
+    return info
+
+class _FixedTimeZipWriter:
+    def __init__(self, file):
+        self._zipf = zipfile.ZipFile(file, "w", compression=zipfile.ZIP_DEFLATED)
+
+    def write(self, pack_uri, blob):
+        self._zipf.writestr(_docx_zip_info(pack_uri.membername), blob)
+
+    def close(self):
+        self._zipf.close()
+
+class _RecordingWriter:
+    def __init__(self):
+        self.entries = []
+
+    def write(self, pack_uri, blob):
+        self.entries.append((pack_uri.membername, blob))
+
+    def close(self):
+        pass
+
+def write_docx_package(doc, writer):
+    # Same steps as OpcPackage.save, but core properties are pinned so the
+    # output does not depend on the time of the call.
+    props = doc.core_properties
+    props.created = EXPORT_TIMESTAMP
+    props.modified = EXPORT_TIMESTAMP
+    props.last_modified_by = "mca-export-worker"
+    props.revision = 1
+    package = doc.part.package
+    parts = package.parts
+    for part in parts:
+        part.before_marshal()
+    PackageWriter._write_content_types_stream(writer, parts)
+    PackageWriter._write_pkg_rels(writer, package.rels)
+    PackageWriter._write_parts(writer, parts)
+    writer.close()
+
+def save_docx(doc, file):
+    write_docx_package(doc, _FixedTimeZipWriter(file))
+
+class DocxSkeleton:
+    # The default template, parsed once and kept as the zip entries
+    # save_docx() writes for an empty document. word/document.xml is split
+    # just before its <w:sectPr> (where python-docx inserts paragraphs), so
+    # stream_docx() only has to produce the body and writes every other
+    # entry as recorded. Style ids and the body width (what add_table()
+    # divides between columns) are kept for the markdown writer.
+    def __init__(self):
+        doc = Document()
+        self.style_ids = {style.name: style.style_id for style in doc.styles}
+        section = doc.sections[-1]
+        self.block_width = section.page_width - section.left_margin - section.right_margin
+        recorder = _RecordingWriter()
+        write_docx_package(doc, recorder)
+        self.entries = recorder.entries
+        for membername, blob in self.entries:
+            if membername == "word/document.xml":
+                split = blob.rindex(b"<w:sectPr")
+                self.head = blob[:split]
+                self.tail = blob[split:]
+
+_docx_skeleton = None
+_docx_skeleton_lock = threading.Lock()
+
+def docx_skeleton() -> DocxSkeleton:
+    global _docx_skeleton
+    if _docx_skeleton is None:
+        with _docx_skeleton_lock:
+            if _docx_skeleton is None:
+                _docx_skeleton = DocxSkeleton()
+    return _docx_skeleton
+
+_DOCX_INVALID_CHARS = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]")
+_DOCX_RUN_SPLIT = re.compile("([\t\r\n])")
+
+def _docx_escape(text: str) -> str:
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+def _docx_t(text: str) -> str:
+    if text.strip() != text:
+        return f'<w:t xml:space="preserve">{_docx_escape(text)}</w:t>'
+    return f"<w:t>{_docx_escape(text)}</w:t>"
+
+def docx_run_xml(text: str, rpr: str = "") -> str:
+    # Serializes exactly what paragraph.add_run(text) would: tabs become
+    # <w:tab/>, CR/LF become <w:br/>, and runs of other characters become
+    # <w:t>, preserving whitespace where python-docx does.
+    if _DOCX_INVALID_CHARS.search(text):
+        raise ValueError("All strings must be XML compatible: Unicode or ASCII, no NULL bytes or control characters")
+    if "\t" not in text and "\r" not in text and "\n" not in text:
+        return f"<w:r>{rpr}{_docx_t(text)}</w:r>"
+    run = []
+    for piece in _DOCX_RUN_SPLIT.split(text):
+        if piece == "\t":
+            run.append("<w:tab/>")
+        elif piece in ("\r", "\n"):
+            run.append("<w:br/>")
+        elif piece:
+            run.append(_docx_t(piece))
+    return f"<w:r>{rpr}{''.join(run)}</w:r>"
+
+def docx_paragraph_xml(text: str, style: str = None) -> str:
+    # Same bytes as doc.add_paragraph(text, style).
+    ppr = f'<w:pPr><w:pStyle w:val="{style}"/></w:pPr>' if style else ""
+    if not text:
+        return f"<w:p>{ppr}</w:p>" if ppr else "<w:p/>"
+    return f"<w:p>{ppr}{docx_run_xml(text)}</w:p>"
+
+# Markdown in DOCX uses the default template's own styles. Spans map to run
+# properties as python-docx writes them for run.bold, run.italic and
+# run.font.name.
+_DOCX_SPAN_RPR = {
+    "": "",
+    "b": "<w:rPr><w:b/></w:rPr>",
+    "i": "<w:rPr><w:i/></w:rPr>",
+    "code": '<w:rPr><w:rFonts w:ascii="Courier New" w:hAnsi="Courier New"/></w:rPr>',
+}
+_DOCX_TABLE_PR = (
+    '<w:tblPr><w:tblStyle w:val="TableGrid"/><w:tblW w:type="auto" w:w="0"/>'
+    '<w:tblLook w:firstColumn="1" w:firstRow="1" w:lastColumn="0" w:lastRow="0" w:noHBand="0" w:noVBand="1" w:val="04A0"/>'
+    "</w:tblPr>"
+)
+
+def markdown_docx_style(kind: str, level: int):
+    if kind == "heading":
+        return f"Heading {level}"
+    if kind in ("bullet", "number"):
+        name = "List Bullet" if kind == "bullet" else "List Number"
+        return f"{name} {level + 1}" if level else name
+    if kind == "code":
+        return "macro"
+    return None
+
+def _add_docx_spans(paragraph, spans: list):
+    for text, kind in spans:
+        run = paragraph.add_run(text)
+        if kind == "b":
+            run.bold = True
+        elif kind == "i":
+            run.italic = True
+        elif kind == "code":
+            run.font.name = "Courier New"
+
+def add_markdown_docx(doc, blocks: list):
+    for kind, level, value in blocks:
+        if kind == "table":
+            rows = markdown_table_spans(value)
+            table = doc.add_table(rows=len(rows), cols=len(rows[0]), style="Table Grid")
+            for row, spans_row in zip(table.rows, rows):
+                for cell, spans in zip(row.cells, spans_row):
+                    _add_docx_spans(cell.paragraphs[0], spans)
+        elif kind == "code":
+            doc.add_paragraph(value, markdown_docx_style(kind, level))
+        else:
+            _add_docx_spans(doc.add_paragraph(style=markdown_docx_style(kind, level)), markdown_spans(value))
+
+def _docx_spans_xml(spans: list, style: str = None) -> str:
+    ppr = f'<w:pPr><w:pStyle w:val="{style}"/></w:pPr>' if style else ""
+    runs = "".join(docx_run_xml(text, _DOCX_SPAN_RPR[kind]) for text, kind in spans)
+    return f"<w:p>{ppr}{runs}</w:p>" if ppr or runs else "<w:p/>"
+
+def markdown_docx_xml(blocks: list):
+    # The body add_markdown_docx() builds, serialized directly.
+    skeleton = docx_skeleton()
+    style_ids = skeleton.style_ids
+    for kind, level, value in blocks:
+        if kind == "table":
+            rows = markdown_table_spans(value)
+            width = Emu(skeleton.block_width // len(rows[0])).twips
+            tcpr = f'<w:tcPr><w:tcW w:type="dxa" w:w="{width}"/></w:tcPr>'
+            grid = f'<w:gridCol w:w="{width}"/>' * len(rows[0])
+            body = "".join(
+                "<w:tr>" + "".join(f"<w:tc>{tcpr}{_docx_spans_xml(spans)}</w:tc>" for spans in row) + "</w:tr>"
+                for row in rows
+            )
+            yield f"<w:tbl>{_DOCX_TABLE_PR}<w:tblGrid>{grid}</w:tblGrid>{body}</w:tbl>"
+            continue
+        style = markdown_docx_style(kind, level)
+        if kind == "code":
+            yield docx_paragraph_xml(value, style_ids[style])
+        else:
+            yield _docx_spans_xml(markdown_spans(value), style_ids[style] if style else None)
+
+def stream_docx(title: str, body, file, chunk_size: int = DOCX_STREAM_CHUNK):
+    # Writes the same bytes as build_docx() through python-docx, but the
+    # body (an iterable of paragraph/table XML strings) is written straight
+    # into the compressed word/document.xml entry instead of being built as
+    # an lxml tree first.
+    skeleton = docx_skeleton()
+    with zipfile.ZipFile(file, "w", compression=zipfile.ZIP_DEFLATED) as zipf:
+        for membername, blob in skeleton.entries:
+            if membername != "word/document.xml":
+                zipf.writestr(_docx_zip_info(membername), blob)
+                continue
+            with zipf.open(_docx_zip_info(membername), "w") as out:
+                out.write(skeleton.head)
+                pending = [docx_paragraph_xml(title, "Heading1")]
+                size = 0
+                for xml in body:
+                    pending.append(xml)
+                    size += len(xml)
+                    if size >= chunk_size:
+                        out.write("".join(pending).encode("utf-8"))
+                        pending.clear()
+                        size = 0
+                out.write("".join(pending).encode("utf-8"))
+                out.write(skeleton.tail)
+
+def iter_csv(lines, chunk_size: int = CSV_STREAM_CHUNK):
     buf = io.StringIO()
     writer = csv.writer(buf)
-    for line in text.replace("\r", "").split("\n"):
-        writer.writerow([line])
-    return buf.getvalue().encode("utf-8")
+    for line in lines:
+        writer.writerow([line.replace("\r", "")])
+        if buf.tell() >= chunk_size:
+            yield buf.getvalue().encode("utf-8")
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue().encode("utf-8")
+
+def generate_csv(text: str) -> bytes:
+    return b"".join(iter_csv(ExportContent(text).iter_lines()))
+
+def render(export_type: str, title: str, content: ExportContent, trace: Trace = None) -> bytes:
+    if export_type == "pdf":
+        return build_pdf(title, content, trace)
+    if export_type == "docx":
+        return build_docx(title, content, trace)
+    if export_type == "csv":
+        with (trace or Trace()).span("csv.write", phase="serialize"):
+            return b"".join(iter_csv(content.iter_lines()))
+    raise ValueError(f"Unsupported export type: {export_type}")
+
+def render_stream(export_type: str, title: str, content: ExportContent, trace: Trace):
+    # render() for the formats sent as they are produced (streamed PDF and
+    # CSV). The phase is credited only with the time spent producing each
+    # chunk, not with the time spent waiting for the client between them.
+    if export_type == "pdf":
+        with trace.span("content.split", phase="parse"):
+            content.paragraphs
+        chunks, phase = iter_pdf_stream(title, content), "layout"
+    else:
+        chunks, phase = iter_csv(content.iter_lines()), "serialize"
+    while True:
+        start = time.perf_counter()
+        chunk = next(chunks, None)
+        trace.add_phase(phase, time.perf_counter() - start)
+        if chunk is None:
+            return
+        yield chunk
+
+class StackSampler:
+    # Statistical profiler for one thread: a background thread snapshots
+    # the target's stack every `interval` seconds and counts identical
+    # stacks, which collapsed() emits in flamegraph.pl's folded format.
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                key = ";".join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(self.stacks.items()))
+
+def profile_call(mode: str, fn, *args):
+    if mode == "cprofile":
+        profiler = cProfile.Profile()
+        result = profiler.runcall(fn, *args)
+        text = io.StringIO()
+        stats = pstats.Stats(profiler, stream=text)
+        dumped = marshal.dumps(stats.stats)
+        stats.sort_stats("cumulative").print_stats(60)
+        return result, {"mode": mode, "text": text.getvalue(), "pstats": dumped}
+    sampler = StackSampler(threading.get_ident(), PROFILE_SAMPLE_INTERVAL)
+    sampler.start()
+    try:
+        result = fn(*args)
+    finally:
+        sampler.stop()
+    return result, {"mode": mode, "text": sampler.collapsed(), "pstats": None}
+
+def render_traced(export_type: str, title: str, content: ExportContent, profile: str = None):
+    # Pool entry point: spans (and the profile, if one was requested) are
+    # recorded where the render runs and returned with the bytes, since a
+    # process-pool worker cannot update the parent's state itself.
+    trace = Trace()
+    profile_result = None
+    with trace.span("render", type=export_type, pid=os.getpid(), profile=profile or ""):
+        if profile:
+            data, profile_result = profile_call(profile, render, export_type, title, content, trace)
+        else:
+            data = render(export_type, title, content, trace)
+    return data, trace.spans, trace.phases, profile_result
+
+def cache_key(export_type: str, title: str, content: ExportContent) -> str:
+    h = hashlib.sha256()
+    if export_type == "pdf":
+        variant = f"{content.pdf_mode}/{content.format}"
+    else:
+        variant = content.format if export_type == "docx" else ""
+    for part in (RENDERER_VERSION, export_type, title, variant):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    # Hashed in slices so a large body is never encoded to bytes in one go.
+    text = content.text
+    for start in range(0, len(text), CACHE_KEY_SLICE):
+        h.update(text[start:start + CACHE_KEY_SLICE].encode("utf-8", "surrogatepass"))
+    return h.hexdigest()
+
+class RenderCache:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            data = self._entries.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._entries[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+render_cache = RenderCache(RENDER_CACHE_BYTES)
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == "*" or tag == etag:
+            return True
+    return False
+
+class DiskRenderCache:
+    # Shared by every uvicorn worker pointing at the same directory. A
+    # file's mtime is its last use: hits touch it, eviction removes the
+    # oldest files once the directory grows past max_bytes, and with a TTL
+    # files idle for longer than ttl seconds are treated as misses.
+    def __init__(self, directory: str, max_bytes: int, ttl: float):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._approx_size = None
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def open(self, key: str):
+        # Returns the entry opened for reading, or None. Callers read from
+        # the open file rather than the path, so another worker evicting
+        # the entry in the meantime cannot turn a hit into an error.
+        path = self.path(key)
+        try:
+            f = open(path, "rb")
+        except OSError:
+            self.misses += 1
+            return None
+        try:
+            if self.ttl and time.time() - os.fstat(f.fileno()).st_mtime > self.ttl:
+                f.close()
+                self._remove(path)
+                self.misses += 1
+                return None
+            os.utime(path)
+        except OSError:
+            pass
+        self.hits += 1
+        return f
+
+    def put(self, key: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        f, tmp = self.spool()
+        try:
+            with f:
+                f.write(data)
+            self.commit(key, tmp, len(data))
+        except BaseException:
+            self.discard(tmp)
+            raise
+
+    def spool(self):
+        # An entry is written to a temporary file in the directory and then
+        # moved into place with commit() (or dropped with discard()), so
+        # readers never see a partial file.
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        return os.fdopen(fd, "wb"), tmp
+
+    def discard(self, tmp: str):
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+
+    def commit(self, key: str, tmp: str, size: int):
+        os.replace(tmp, self.path(key))
+        with self._lock:
+            if self._approx_size is not None:
+                self._approx_size += size
+            if self._approx_size is None or self._approx_size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        now = time.time()
+        files = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith(".tmp-"):
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            if self.ttl and now - st.st_mtime > self.ttl:
+                self._remove(entry.path)
+                continue
+            files.append((st.st_mtime, st.st_size, entry.path))
+            total += st.st_size
+        if total > self.max_bytes:
+            files.sort()
+            target = self.max_bytes * 0.9
+            for _, size, path in files:
+                if total <= target:
+                    break
+                if self._remove(path):
+                    total -= size
+        self._approx_size = total
+
+    def _remove(self, path: str) -> bool:
+        try:
+            os.unlink(path)
+        except OSError:
+            return False
+        self.evictions += 1
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "directory": self.directory,
+            "approx_bytes": self._approx_size,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+disk_cache = DiskRenderCache(RENDER_CACHE_DIR, RENDER_CACHE_DIR_BYTES, RENDER_CACHE_TTL) if RENDER_CACHE_DIR else None
+
+class Overloaded(Exception):
+    def __init__(self, status_code: int, reason: str, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.reason = reason
+        self.detail = detail
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{n}="{v}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels[n] for n in self.labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, value: float, **labels):
+        # For counters, only to mirror a running total kept elsewhere (the
+        # caches count their own hits/misses/evictions).
+        self._values[tuple(labels[n] for n in self.labels)] = value
+
+    def snapshot(self) -> dict:
+        return {",".join(map(str, key)): value for key, value in self._values.items()}
+
+    def render(self) -> list:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self._values.items()):
+            out.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+        return out
+
+class Gauge(Counter):
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def render(self) -> list:
+        out = super().render()
+        out[1] = f"# TYPE {self.name} gauge"
+        return out
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: tuple, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.labels = labels
+        self._series = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels[n] for n in self.labels)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+        counts = series[0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        series[1] += value
+        series[2] += 1
+
+    def render(self) -> list:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total, count) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                le = 'le="%g"' % bound
+                out.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+            le = 'le="+Inf"'
+            out.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {count}")
+            out.append(f"{self.name}_sum{_format_labels(self.labels, key)} {total}")
+            out.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return out
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+SIZE_BUCKETS = tuple(1 << n for n in range(10, 31, 2))
+RENDER_SECONDS = Histogram("export_render_seconds", "Time spent rendering one export, excluding queueing.", LATENCY_BUCKETS, ("type",))
+PHASE_SECONDS = Histogram("export_phase_seconds", "Time spent per export phase (parse, queue, layout, serialize).", LATENCY_BUCKETS, ("type", "phase"))
+INPUT_BYTES = Histogram("export_input_chars", "Size of the export content in characters.", SIZE_BUCKETS, ("type",))
+OUTPUT_BYTES = Histogram("export_output_bytes", "Size of the rendered export in bytes.", SIZE_BUCKETS, ("type",))
+RENDER_ERRORS = Counter("export_render_errors_total", "Renders that raised an exception.", ("type",))
+HTTP_RESPONSES = Counter("export_http_responses_total", "HTTP responses by route and status code.", ("route", "status"))
+SHED = Counter("export_shed_total", "Requests refused by admission control.", ("reason",))
+HTTP_IN_FLIGHT = Gauge("export_http_in_flight", "HTTP requests currently being handled.")
+RENDERS_IN_FLIGHT = Gauge("export_renders_in_flight", "Renders currently running on the pool.", ("lane",))
+RENDERS_QUEUED = Gauge("export_renders_queued", "Renders waiting for a pool slot.", ("lane",))
+JOBS_QUEUED = Gauge("export_jobs_queued", "Jobs waiting for a job worker.")
+CACHE_HITS = Counter("export_cache_hits_total", "Render cache hits.", ("cache",))
+CACHE_MISSES = Counter("export_cache_misses_total", "Render cache misses.", ("cache",))
+CACHE_EVICTIONS = Counter("export_cache_evictions_total", "Entries evicted from the render cache.", ("cache",))
+CACHE_BYTES = Gauge("export_cache_bytes", "Bytes held by the render cache.", ("cache",))
+METRICS = (
+    RENDER_SECONDS, PHASE_SECONDS, INPUT_BYTES, OUTPUT_BYTES, RENDER_ERRORS, HTTP_RESPONSES, SHED,
+    HTTP_IN_FLIGHT, RENDERS_IN_FLIGHT, RENDERS_QUEUED, JOBS_QUEUED,
+    CACHE_HITS, CACHE_MISSES, CACHE_EVICTIONS, CACHE_BYTES,
+)
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            HTTP_IN_FLIGHT.dec()
+            route = scope.get("route")
+            HTTP_RESPONSES.inc(route=getattr(route, "path", "unmatched"), status=status)
+
+class TracingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not TRACE_SINKS or not scope["path"].startswith("/api/"):
+            await self.app(scope, receive, send)
+            return
+        trace = Trace(f"{scope['method']} {scope['path']}")
+        token = current_trace.set(trace)
+        try:
+            with trace.span(trace.name, method=scope["method"], path=scope["path"]):
+                await self.app(scope, receive, send)
+        finally:
+            current_trace.reset(token)
+            emit_trace(trace)
+
+def render_metrics() -> str:
+    pool = render_pool.stats()
+    RENDERS_IN_FLIGHT.set(pool["in_flight"] - pool["slow_lane"]["in_flight"], lane="fast")
+    RENDERS_IN_FLIGHT.set(pool["slow_lane"]["in_flight"], lane="slow")
+    RENDERS_QUEUED.set(pool["fast_lane"]["queued"], lane="fast")
+    RENDERS_QUEUED.set(pool["slow_lane"]["queued"], lane="slow")
+    JOBS_QUEUED.set(job_queue.stats()["queued"])
+    caches = {"memory": render_cache.stats()}
+    if disk_cache is not None:
+        caches["disk"] = disk_cache.stats()
+    for name, stats in caches.items():
+        CACHE_HITS.set(stats["hits"], cache=name)
+        CACHE_MISSES.set(stats["misses"], cache=name)
+        CACHE_EVICTIONS.set(stats["evictions"], cache=name)
+        CACHE_BYTES.set(stats.get("bytes", stats.get("approx_bytes")) or 0, cache=name)
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+def check_content_length(request: Request):
+    if not MAX_CONTENT_BYTES:
+        return
+    length = request.headers.get("content-length")
+    if length and length.isdigit() and int(length) > MAX_CONTENT_BYTES:
+        raise Overloaded(413, "content_too_large", f"Request body exceeds {MAX_CONTENT_BYTES} bytes")
+
+async def iter_body(request: Request):
+    check_content_length(request)
+    received = 0
+    async for chunk in request.stream():
+        received += len(chunk)
+        if MAX_CONTENT_BYTES and received > MAX_CONTENT_BYTES:
+            raise Overloaded(413, "content_too_large", f"Request body exceeds {MAX_CONTENT_BYTES} bytes")
+        yield chunk
+
+async def read_json(request: Request):
+    body = bytearray()
+    async for chunk in iter_body(request):
+        body += chunk
+    with traced("json.decode", phase="parse", bytes=len(body)):
+        try:
+            return json.loads(body)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid JSON body")
+
+async def iter_ndjson(request: Request):
+    buf = bytearray()
+    async for chunk in iter_body(request):
+        buf += chunk
+        start = 0
+        while True:
+            end = buf.find(b"\n", start)
+            if end < 0:
+                break
+            record = bytes(buf[start:end]).strip()
+            start = end + 1
+            if record:
+                yield json.loads(record)
+        del buf[:start]
+    if buf.strip():
+        yield json.loads(bytes(buf))
+
+async def read_ndjson_export(request: Request):
+    # The first record carries the export options ({"type", "title", ...}),
+    # every following record is a content chunk, either a bare JSON string
+    # or {"content": "..."}. Only the undecoded tail of the body is buffered
+    # as bytes. Chunks are joined into blocks of about OFFLOAD_SIZE
+    # characters as they arrive, so many small records do not leave one
+    # string object each behind. The content still ends up as one string
+    # (ExportContent needs it for the cache key before anything renders),
+    # and the final join briefly holds it twice.
+    header = None
+    blocks = []
+    pending = []
+    pending_size = 0
+    try:
+        async for record in iter_ndjson(request):
+            if header is None:
+                if not isinstance(record, dict):
+                    raise HTTPException(status_code=400, detail="First NDJSON record must be an object")
+                header = record
+                chunk = record.get("content") or ""
+            else:
+                chunk = record.get("content") if isinstance(record, dict) else record
+            if not isinstance(chunk, str):
+                raise HTTPException(status_code=400, detail="NDJSON content chunks must be strings")
+            pending.append(chunk)
+            pending_size += len(chunk)
+            if pending_size >= OFFLOAD_SIZE:
+                blocks.append("".join(pending))
+                pending = []
+                pending_size = 0
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid NDJSON body")
+    if header is None:
+        raise HTTPException(status_code=400, detail="Empty NDJSON body")
+    blocks.append("".join(pending))
+    return header, ExportContent("".join(blocks))
+
+def _warm_render_worker():
+    # Runs once in each process-pool worker so the first real job does not
+    # pay for importing reportlab/python-docx, building the sample
+    # stylesheet, loading font metrics or parsing the DOCX template.
+    pdf_styles()
+    docx_skeleton()
+    for export_type in EXPORT_TYPES:
+        render(export_type, "warmup", ExportContent("warmup"))
+    for pdf_mode in ("fast", "platypus"):
+        render("pdf", "warmup", ExportContent("warmup", pdf_mode))
+
+def _ping() -> bool:
+    return True
+
+def estimate_cost(export_type: str, content: ExportContent) -> float:
+    return RENDER_COST_WEIGHTS[export_type] * (content.size + RENDER_COST_PER_LINE * content.line_count())
+
+_STREAM_END = object()
+
+class RenderPool:
+    # Scheduler in front of the executor. Jobs whose estimated cost is at
+    # most fast_lane_cost go in the fast lane: they are dispatched before
+    # anything in the slow lane and fast_lane_slots of the max_concurrency
+    # slots are kept free for them, so a burst of large renders cannot
+    # occupy every slot. A tenant never has more than tenant_concurrency
+    # renders in flight; its extra jobs wait without blocking other tenants.
+    def __init__(self, kind: str, workers: int, max_concurrency: int,
+                 fast_lane_cost: float = 0, fast_lane_slots: int = 0, tenant_concurrency: int = 0,
+                 max_queued: int = 0, tenant_max_queued: int = 0):
+        if kind not in ("thread", "process"):
+            raise ValueError(f"Unknown RENDER_POOL: {kind}")
+        self.kind = kind
+        self.workers = workers
+        self.max_concurrency = max_concurrency
+        self.fast_lane_cost = fast_lane_cost
+        self.fast_lane_slots = min(fast_lane_slots, max_concurrency - 1) if max_concurrency > 1 else 0
+        self.tenant_concurrency = tenant_concurrency
+        self.max_queued = max_queued
+        self.tenant_max_queued = tenant_max_queued
+        self.tenant_queued = {}
+        self.queued = 0
+        self.in_flight = 0
+        self.slow_in_flight = 0
+        self.tenant_in_flight = {}
+        self._fast_waiters = []
+        self._slow_waiters = []
+        self._executor = None
+        self._loop = None
+
+    def start(self):
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context(RENDER_MP_START),
+                    initializer=_warm_render_worker,
+                )
+                for _ in range(self.workers):
+                    self._executor.submit(_ping)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="render")
+                pdf_styles()
+                docx_skeleton()
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        self._loop = None
+
+    def check_admission(self, tenant: str, n: int = 1):
+        # n > 1 admits a bundle: all of its renders count as queued.
+        if self.max_queued and self.queued + n > self.max_queued:
+            raise Overloaded(503, "queue_full", "Render queue is full")
+        if self.tenant_max_queued and self.tenant_queued.get(tenant, 0) + n > self.tenant_max_queued:
+            raise Overloaded(429, "tenant_queue_full", "Too many queued renders for this API key")
+
+    async def run(self, fn, *args, cost: float = 0, tenant: str = "default", shed: bool = True, on_start=None):
+        self.start()
+        fast = cost <= self.fast_lane_cost
+        await self._wait_slot(fast, tenant, shed)
+        if on_start is not None:
+            on_start()
+        try:
+            future = self._executor.submit(fn, *args)
+        except BaseException:
+            self._release(fast, tenant)
+            raise
+        # The slot is held until the render itself finishes, not until the
+        # awaiting request goes away, so a disconnected client cannot push
+        # more work onto the pool than max_concurrency allows.
+        future.add_done_callback(lambda _: self._loop.call_soon_threadsafe(self._release, fast, tenant))
+        return await asyncio.wrap_future(future)
+
+    async def stream(self, fn, *args, cost: float = 0, tenant: str = "default", shed: bool = True, on_start=None):
+        # run() for a generator function: takes a slot the same way, then
+        # yields its chunks as they are produced. The producer blocks once
+        # RENDER_STREAM_QUEUE chunks are waiting, so a slow client holds
+        # back the render instead of letting output pile up in memory. A
+        # generator cannot be sent to a worker process, so in process mode
+        # the producer runs on a thread but still holds one of the slots.
+        self.start()
+        fast = cost <= self.fast_lane_cost
+        await self._wait_slot(fast, tenant, shed)
+        if on_start is not None:
+            on_start()
+        loop = self._loop
+        queue = asyncio.Queue(RENDER_STREAM_QUEUE)
+        stop = threading.Event()
+
+        def produce():
+            try:
+                for chunk in fn(*args):
+                    if stop.is_set():
+                        return
+                    asyncio.run_coroutine_threadsafe(queue.put(chunk), loop).result()
+                item = _STREAM_END
+            except BaseException as exc:
+                item = exc
+            if not stop.is_set():
+                asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+        try:
+            future = loop.run_in_executor(self._executor if self.kind == "thread" else None, produce)
+        except BaseException:
+            self._release(fast, tenant)
+            raise
+        future.add_done_callback(lambda _: self._release(fast, tenant))
+        try:
+            while True:
+                item = await queue.get()
+                if item is _STREAM_END:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            # Unblock a producer waiting on a full queue so it sees `stop`.
+            stop.set()
+            while not queue.empty():
+                queue.get_nowait()
+
+    async def _wait_slot(self, fast: bool, tenant: str, shed: bool):
+        if self._can_start(fast, tenant):
+            self._acquire(fast, tenant)
+            return
+        if shed:
+            self.check_admission(tenant)
+        waiter = (self._loop.create_future(), fast, tenant)
+        (self._fast_waiters if fast else self._slow_waiters).append(waiter)
+        self.queued += 1
+        self.tenant_queued[tenant] = self.tenant_queued.get(tenant, 0) + 1
+        try:
+            await waiter[0]
+        except asyncio.CancelledError:
+            if waiter[0].done() and not waiter[0].cancelled():
+                self._release(fast, tenant)
+            else:
+                (self._fast_waiters if fast else self._slow_waiters).remove(waiter)
+            raise
+        finally:
+            self.queued -= 1
+            count = self.tenant_queued[tenant] - 1
+            if count:
+                self.tenant_queued[tenant] = count
+            else:
+                del self.tenant_queued[tenant]
+
+    def _can_start(self, fast: bool, tenant: str) -> bool:
+        if self.in_flight >= self.max_concurrency:
+            return False
+        if not fast and self.slow_in_flight >= self.max_concurrency - self.fast_lane_slots:
+            return False
+        if self.tenant_concurrency and self.tenant_in_flight.get(tenant, 0) >= self.tenant_concurrency:
+            return False
+        return True
+
+    def _acquire(self, fast: bool, tenant: str):
+        self.in_flight += 1
+        if not fast:
+            self.slow_in_flight += 1
+        self.tenant_in_flight[tenant] = self.tenant_in_flight.get(tenant, 0) + 1
+
+    def _release(self, fast: bool, tenant: str):
+        self.in_flight -= 1
+        if not fast:
+            self.slow_in_flight -= 1
+        count = self.tenant_in_flight[tenant] - 1
+        if count:
+            self.tenant_in_flight[tenant] = count
+        else:
+            del self.tenant_in_flight[tenant]
+        self._dispatch()
+
+    def _dispatch(self):
+        for waiters in (self._fast_waiters, self._slow_waiters):
+            i = 0
+            while i < len(waiters) and self.in_flight < self.max_concurrency:
+                future, fast, tenant = waiters[i]
+                if future.cancelled():
+                    del waiters[i]
+                elif self._can_start(fast, tenant):
+                    del waiters[i]
+                    self._acquire(fast, tenant)
+                    future.set_result(None)
+                else:
+                    i += 1
+
+    def stats(self) -> dict:
+        return {
+            "kind": self.kind,
+            "start_method": RENDER_MP_START if self.kind == "process" else None,
+            "workers": self.workers,
+            "max_concurrency": self.max_concurrency,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "max_queued": self.max_queued,
+            "fast_lane": {"reserved_slots": self.fast_lane_slots, "max_cost": self.fast_lane_cost, "queued": len(self._fast_waiters)},
+            "slow_lane": {"in_flight": self.slow_in_flight, "queued": len(self._slow_waiters)},
+            "tenant_concurrency": self.tenant_concurrency,
+            "tenants_in_flight": len(self.tenant_in_flight),
+        }
+
+    def tenant_stats(self) -> dict:
+        return {
+            tenant: {"in_flight": self.tenant_in_flight.get(tenant, 0), "queued": self.tenant_queued.get(tenant, 0)}
+            for tenant in sorted(set(self.tenant_in_flight) | set(self.tenant_queued))
+        }
+
+render_pool = RenderPool(
+    RENDER_POOL,
+    RENDER_WORKERS,
+    RENDER_MAX_CONCURRENCY,
+    fast_lane_cost=RENDER_FAST_LANE_COST,
+    fast_lane_slots=RENDER_FAST_LANE_SLOTS,
+    tenant_concurrency=RENDER_TENANT_CONCURRENCY,
+    max_queued=RENDER_MAX_QUEUED,
+    tenant_max_queued=RENDER_TENANT_MAX_QUEUED,
+)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    render_pool.start()
+    await job_queue.start()
+    try:
+        yield
+    finally:
+        await job_queue.stop()
+        render_pool.shutdown()
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(TracingMiddleware)
+app.add_middleware(MetricsMiddleware)
+
+@app.exception_handler(Overloaded)
+async def overloaded_handler(request: Request, exc: Overloaded):
+    SHED.inc(reason=exc.reason)
+    headers = {"Retry-After": str(RETRY_AFTER_SECONDS)} if exc.status_code in (429, 503) else None
+    return JSONResponse({"detail": exc.detail}, status_code=exc.status_code, headers=headers)
 
 @app.get("/")
 async def root():
-    return {"ok": True, "service": "mca-export-worker"}
+    return {
+        "ok": True,
+        "service": "mca-export-worker",
+        "render": render_pool.stats(),
+        "cache": render_cache.stats(),
+        "disk_cache": disk_cache.stats() if disk_cache else None,
+        "jobs": job_queue.stats(),
+        "shed": SHED.snapshot(),
+    }
 
-@app.post("/api/generate")
-async def generate(request: Request):
-    if not PY_WORKER_KEY:
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+def check_auth(request: Request) -> str:
+    if not API_KEYS:
         raise HTTPException(status_code=500, detail="PY_WORKER_KEY not set")
 
     auth_header = request.headers.get("authorization", "")
-    if auth_header != f"Bearer {PY_WORKER_KEY}":
+    scheme, _, token = auth_header.partition(" ")
+    tenant = API_KEYS.get(token) if scheme == "Bearer" else None
+    if tenant is None:
         raise HTTPException(status_code=401, detail="Unauthorized")
+    return tenant
 
-    body = await request.json()
-    export_type = (body.get("type") or "").lower()
-    title = body.get("title") or "Solace Export"
-    content = body.get("content") or ""
+def read_title(options: dict) -> str:
+    title = options.get("title") or "Solace Export"
+    if not isinstance(title, str):
+        raise HTTPException(status_code=400, detail="title must be a string")
+    return title
 
-    if export_type == "pdf":
-        data = generate_pdf(title, content)
-        media = "application/pdf"
-        filename = "solace-export.pdf"
-    elif export_type == "docx":
-        data = generate_docx(title, content)
-        media = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
-        filename = "solace-export.docx"
-    elif export_type == "csv":
-        data = generate_csv(content)
-        media = "text/csv"
-        filename = "solace-export.csv"
+def read_content_options(options: dict) -> dict:
+    pdf_mode = (options.get("pdf_mode") or PDF_MODE).lower()
+    if pdf_mode not in PDF_MODES:
+        raise HTTPException(status_code=400, detail=f"pdf_mode must be one of {', '.join(PDF_MODES)}")
+    content_format = (options.get("format") or "text").lower()
+    if content_format not in CONTENT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(CONTENT_FORMATS)}")
+    return {"pdf_mode": pdf_mode, "format": content_format}
+
+def apply_content_options(content: ExportContent, options: dict):
+    content.format = options["format"]
+    # Markdown and markup are laid out by platypus; the fast and streaming
+    # PDF writers only handle plain paragraphs and would print tags
+    # literally. ("auto" already sends markup with tags to platypus.)
+    pdf_mode = options["pdf_mode"]
+    if content.format == "markdown" or (content.format == "markup" and pdf_mode in ("fast", "stream")):
+        pdf_mode = "platypus"
+    content.pdf_mode = pdf_mode
+
+def check_admin(request: Request):
+    admin_key = request.headers.get("x-admin-key", "")
+    if not PY_ADMIN_KEY or not hmac.compare_digest(admin_key.encode(), PY_ADMIN_KEY.encode()):
+        raise HTTPException(status_code=403, detail="Admin key required")
+
+def requested_profile(request: Request):
+    mode = (request.headers.get("x-profile") or request.query_params.get("profile") or "").lower()
+    if not mode:
+        return None
+    check_admin(request)
+    if mode not in PROFILE_MODES:
+        raise HTTPException(status_code=400, detail=f"profile must be one of {', '.join(PROFILE_MODES)}")
+    return mode
+
+async def export_cache_key(export_type: str, title: str, content: ExportContent) -> str:
+    if content.size >= OFFLOAD_SIZE:
+        return await asyncio.to_thread(cache_key, export_type, title, content)
+    return cache_key(export_type, title, content)
+
+def queue_timer(export_type: str):
+    queued_at = time.perf_counter()
+
+    def on_start():
+        waited = time.perf_counter() - queued_at
+        PHASE_SECONDS.observe(waited, type=export_type, phase="queue")
+        trace = current_trace.get()
+        if trace is not None:
+            trace.add_phase("queue", waited)
+
+    return on_start
+
+async def _run_render(export_type: str, title: str, content: ExportContent, tenant: str,
+                      shed: bool = True, profile: str = None):
+    cost = estimate_cost(export_type, content)
+    try:
+        data, spans, phases, profile_result = await render_pool.run(
+            render_traced, export_type, title, content, profile,
+            cost=cost, tenant=tenant, shed=shed, on_start=queue_timer(export_type),
+        )
+    except Overloaded:
+        raise
+    except Exception:
+        RENDER_ERRORS.inc(type=export_type)
+        raise
+    trace = current_trace.get()
+    if trace is not None:
+        trace.adopt(spans, phases)
+    for phase, seconds in phases.items():
+        PHASE_SECONDS.observe(seconds, type=export_type, phase=phase)
+    RENDER_SECONDS.observe(sum(phases.values()), type=export_type)
+    INPUT_BYTES.observe(content.size, type=export_type)
+    OUTPUT_BYTES.observe(len(data), type=export_type)
+    return data, profile_result
+
+async def store_render(key: str, data: bytes):
+    render_cache.put(key, data)
+    if disk_cache is not None:
+        await asyncio.to_thread(disk_cache.put, key, data)
+
+async def render_and_store(key: str, export_type: str, title: str, content: ExportContent, tenant: str,
+                           shed: bool = True) -> bytes:
+    data, _ = await _run_render(export_type, title, content, tenant, shed)
+    await store_render(key, data)
+    return data
+
+async def stream_and_store(key: str, export_type: str, title: str, content: ExportContent, tenant: str):
+    # Streaming counterpart of render_and_store(): the caller has already
+    # checked admission, so this waits for a slot rather than shedding
+    # (headers are sent by then). The output is never collected in memory:
+    # with a disk cache it is spooled to a temporary file there by the
+    # producing thread and moved into place once the last chunk is out;
+    # without one, only outputs of at most STREAM_CACHE_BYTES are kept for
+    # the memory cache.
+    cost = estimate_cost(export_type, content)
+    trace = Trace()
+    spool = tmp = None
+    if disk_cache is not None:
+        spool, tmp = await asyncio.to_thread(disk_cache.spool)
+
+    def produce():
+        chunks = render_stream(export_type, title, content, trace)
+        if spool is None:
+            yield from chunks
+            return
+        written = 0
+        with spool:
+            for chunk in chunks:
+                written += len(chunk)
+                if written <= disk_cache.max_bytes:
+                    spool.write(chunk)
+                yield chunk
+
+    chunks = []
+    size = 0
+    try:
+        async for chunk in render_pool.stream(
+            produce, cost=cost, tenant=tenant, shed=False, on_start=queue_timer(export_type),
+        ):
+            size += len(chunk)
+            if spool is None and size <= STREAM_CACHE_BYTES:
+                chunks.append(chunk)
+            elif chunks:
+                chunks.clear()
+            yield chunk
+    except BaseException as exc:
+        if tmp is not None:
+            # The producer may never have started (cancelled while queued),
+            # so the spool is closed here too; closing twice is harmless.
+            spool.close()
+            disk_cache.discard(tmp)
+        if isinstance(exc, Exception):
+            RENDER_ERRORS.inc(type=export_type)
+        raise
+    for phase, seconds in trace.phases.items():
+        PHASE_SECONDS.observe(seconds, type=export_type, phase=phase)
+    RENDER_SECONDS.observe(sum(trace.phases.values()), type=export_type)
+    INPUT_BYTES.observe(content.size, type=export_type)
+    OUTPUT_BYTES.observe(size, type=export_type)
+    if tmp is not None:
+        if size <= disk_cache.max_bytes:
+            await asyncio.to_thread(disk_cache.commit, key, tmp, size)
+        else:
+            await asyncio.to_thread(disk_cache.discard, tmp)
+    elif size <= STREAM_CACHE_BYTES:
+        render_cache.put(key, b"".join(chunks))
+
+profile_store = OrderedDict()
+
+async def render_profiled(key: str, export_type: str, title: str, content: ExportContent, tenant: str, mode: str):
+    data, profile_result = await _run_render(export_type, title, content, tenant, profile=mode)
+    await store_render(key, data)
+    profile_id = uuid.uuid4().hex
+    profile_result.update(id=profile_id, type=export_type, tenant=tenant, created=time.time(), chars=content.size)
+    profile_store[profile_id] = profile_result
+    while len(profile_store) > PROFILE_KEEP:
+        profile_store.popitem(last=False)
+    return data, profile_id
+
+def _read_file(f) -> bytes:
+    with f:
+        return f.read()
+
+def iter_file(f, chunk_size: int = 64 << 10):
+    with f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+async def get_or_render(export_type: str, title: str, content: ExportContent, tenant: str,
+                        shed: bool = True) -> bytes:
+    key = await export_cache_key(export_type, title, content)
+    data = render_cache.get(key)
+    if data is None and disk_cache is not None:
+        f = disk_cache.open(key)
+        if f is not None:
+            try:
+                data = await asyncio.to_thread(_read_file, f)
+            except OSError:
+                data = None
+    if data is None:
+        data = await render_and_store(key, export_type, title, content, tenant, shed)
+    return data
+
+def export_filename(index: int, title: str, export_type: str) -> str:
+    stem = re.sub(r"[^A-Za-z0-9._-]+", "-", title).strip("-.")[:60] or "solace-export"
+    return f"{index:03d}-{stem}.{export_type}"
+
+class _ChunkSink(io.RawIOBase):
+    # Unseekable target for zipfile: entries are written with data
+    # descriptors and the caller drains whatever has been written so far.
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+async def _render_item(index: int, item: dict, limit: asyncio.Semaphore):
+    name = export_filename(index, item["title"], item["type"])
+    try:
+        async with limit:
+            data = await get_or_render(item["type"], item["title"], item["content"], item["tenant"], shed=False)
+    except Exception as exc:
+        return index, f"{index:03d}-error.txt", "text/plain", f"{type(exc).__name__}: {exc}".encode("utf-8")
+    return index, name, EXPORT_TYPES[item["type"]][0], data
+
+async def _iter_completed(items: list):
+    # One bundle never has more than max_concurrency items in the render
+    # queue at once, so a large batch cannot crowd out other requests.
+    limit = asyncio.Semaphore(render_pool.max_concurrency)
+    tasks = [asyncio.ensure_future(_render_item(i, item, limit)) for i, item in enumerate(items)]
+    try:
+        for done in asyncio.as_completed(tasks):
+            yield await done
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def stream_zip(items: list, compression: int):
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, "w", compression=compression) as zf:
+        async for _, name, _, data in _iter_completed(items):
+            info = zipfile.ZipInfo(name, date_time=EXPORT_ZIP_DATE_TIME)
+            info.compress_type = compression
+            info.external_attr = 0o600 << 16
+            await asyncio.to_thread(zf.writestr, info, data)
+            yield sink.drain()
+    yield sink.drain()
+
+async def stream_multipart(items: list, boundary: str):
+    async for index, name, media, data in _iter_completed(items):
+        yield (
+            f"--{boundary}\r\n"
+            f"Content-Type: {media}\r\n"
+            f'Content-Disposition: attachment; filename="{name}"\r\n'
+            f"Content-Length: {len(data)}\r\n"
+            f"X-Item-Index: {index}\r\n\r\n"
+        ).encode("utf-8") + data + b"\r\n"
+    yield f"--{boundary}--\r\n".encode("utf-8")
+
+async def parse_batch_items(raw, tenant: str) -> list:
+    if not isinstance(raw, list) or not raw:
+        raise HTTPException(status_code=400, detail="items must be a non-empty list")
+    if len(raw) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_ITEMS} items per batch")
+    items = []
+    for entry in raw:
+        if not isinstance(entry, dict):
+            raise HTTPException(status_code=400, detail="Each item must be an object")
+        export_type = (entry.get("type") or "").lower()
+        if export_type not in EXPORT_TYPES:
+            raise HTTPException(status_code=400, detail="Unsupported export type")
+        content = entry.get("content") or ""
+        if not isinstance(content, str):
+            raise HTTPException(status_code=400, detail="content must be a string")
+        options = read_content_options(entry)
+        content = ExportContent(content)
+        apply_content_options(content, options)
+        items.append({
+            "type": export_type,
+            "title": read_title(entry),
+            "content": content,
+            "tenant": tenant,
+        })
+    return items
+
+def bundle_response(items: list, body: dict):
+    # _iter_completed() queues at most max_concurrency items at a time, so
+    # that is what the bundle is admitted for.
+    render_pool.check_admission(items[0]["tenant"], n=min(len(items), render_pool.max_concurrency))
+    output = (body.get("output") or "zip").lower()
+    if output == "zip":
+        compression = (body.get("compression") or "deflate").lower()
+        if compression not in ("deflate", "stored"):
+            raise HTTPException(status_code=400, detail="compression must be deflate or stored")
+        mode = zipfile.ZIP_DEFLATED if compression == "deflate" else zipfile.ZIP_STORED
+        headers = {"Content-Disposition": 'attachment; filename="solace-export.zip"'}
+        return StreamingResponse(stream_zip(items, mode), media_type="application/zip", headers=headers)
+    if output == "multipart":
+        boundary = uuid.uuid4().hex
+        return StreamingResponse(stream_multipart(items, boundary), media_type=f"multipart/mixed; boundary={boundary}")
+    raise HTTPException(status_code=400, detail="output must be zip or multipart")
+
+JOB_FIELDS = ("id", "status", "tenant", "type", "title", "callback_url", "created", "updated", "error", "size")
+JOB_UNFINISHED = ("queued", "running")
+
+class MemoryJobStore:
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def create(self, job: dict, content: ExportContent):
+        with self._lock:
+            self._jobs[job["id"]] = dict(job, content=content, result=None)
+
+    def get(self, job_id: str):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return None if job is None else {k: job[k] for k in JOB_FIELDS}
+
+    def claim(self, job_id: str):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job["status"] != "queued":
+                return None
+            job["status"] = "running"
+            job["updated"] = time.time()
+            return job["content"]
+
+    def touch(self, job_id: str):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None and job["status"] == "running":
+                job["updated"] = time.time()
+
+    def release(self, job_id: str):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None and job["status"] == "running":
+                job.update(status="queued", updated=time.time())
+
+    def requeue_stale(self, before: float) -> list:
+        with self._lock:
+            stale = [k for k, job in self._jobs.items() if job["status"] == "running" and job["updated"] < before]
+            for job_id in stale:
+                self._jobs[job_id].update(status="queued", updated=time.time())
+            return stale
+
+    def finish(self, job_id: str, status: str, result: bytes = None, error: str = None):
+        with self._lock:
+            job = self._jobs[job_id]
+            job.update(
+                status=status,
+                result=result,
+                size=None if result is None else len(result),
+                error=error,
+                content=None,
+                updated=time.time(),
+            )
+
+    def result(self, job_id: str):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return None if job is None else job["result"]
+
+    def queued(self) -> list:
+        with self._lock:
+            return [job_id for job_id, job in self._jobs.items() if job["status"] == "queued"]
+
+    def purge(self, before: float):
+        with self._lock:
+            for job_id in [k for k, job in self._jobs.items() if job["status"] not in JOB_UNFINISHED and job["updated"] < before]:
+                del self._jobs[job_id]
+
+class SqliteJobStore:
+    # Survives restarts and can be shared by every uvicorn worker on the
+    # host: jobs are claimed with a conditional UPDATE, so a queued job is
+    # only ever run once even if several workers re-enqueue it on startup.
+    # A running job's `updated` is its lease: the worker running it renews
+    # it, and a job whose lease has run out (its worker died) goes back to
+    # queued.
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, status TEXT NOT NULL, tenant TEXT NOT NULL, type TEXT NOT NULL, title TEXT NOT NULL, "
+                "callback_url TEXT, created REAL NOT NULL, updated REAL NOT NULL, error TEXT, size INTEGER, "
+                "content TEXT, result BLOB, pdf_mode TEXT, format TEXT)"
+            )
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+            for column in ("pdf_mode", "format"):
+                if column not in columns:
+                    self._conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} TEXT")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, updated)")
+
+    def create(self, job: dict, content: ExportContent):
+        with self._lock:
+            self._conn.execute(
+                f"INSERT INTO jobs ({', '.join(JOB_FIELDS)}, content, pdf_mode, format) VALUES ({', '.join('?' * (len(JOB_FIELDS) + 3))})",
+                [job[k] for k in JOB_FIELDS] + [content.text, content.pdf_mode, content.format],
+            )
+
+    def get(self, job_id: str):
+        with self._lock:
+            row = self._conn.execute(f"SELECT {', '.join(JOB_FIELDS)} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return None if row is None else dict(zip(JOB_FIELDS, row))
+
+    def claim(self, job_id: str):
+        with self._lock:
+            cur = self._conn.execute(
+                "UPDATE jobs SET status = 'running', updated = ? WHERE id = ? AND status = 'queued'",
+                (time.time(), job_id),
+            )
+            if cur.rowcount != 1:
+                return None
+            text, pdf_mode, content_format = self._conn.execute(
+                "SELECT content, pdf_mode, format FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        return ExportContent(text, pdf_mode or PDF_MODE, content_format or "text")
+
+    def touch(self, job_id: str):
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET updated = ? WHERE id = ? AND status = 'running'", (time.time(), job_id))
+
+    def release(self, job_id: str):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'queued', updated = ? WHERE id = ? AND status = 'running'", (time.time(), job_id)
+            )
+
+    def requeue_stale(self, before: float) -> list:
+        with self._lock:
+            rows = self._conn.execute(
+                "UPDATE jobs SET status = 'queued', updated = ? WHERE status = 'running' AND updated < ? RETURNING id",
+                (time.time(), before),
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def finish(self, job_id: str, status: str, result: bytes = None, error: str = None):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, size = ?, error = ?, content = NULL, updated = ? WHERE id = ?",
+                (status, result, None if result is None else len(result), error, time.time(), job_id),
+            )
+
+    def result(self, job_id: str):
+        with self._lock:
+            row = self._conn.execute("SELECT result FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return None if row is None else row[0]
+
+    def queued(self) -> list:
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT id FROM jobs WHERE status = 'queued' ORDER BY created")]
+
+    def purge(self, before: float):
+        with self._lock:
+            self._conn.execute("DELETE FROM jobs WHERE status NOT IN ('queued', 'running') AND updated < ?", (before,))
+
+def job_status(job: dict) -> dict:
+    status = dict(job)
+    status["status_url"] = f"/api/jobs/{job['id']}"
+    status["result_url"] = f"/api/jobs/{job['id']}/result" if job["status"] == "done" else None
+    return status
+
+def callback_allowed(url: str) -> bool:
+    try:
+        parts = urllib.parse.urlsplit(url)
+    except ValueError:
+        return False
+    host = (parts.hostname or "").lower()
+    if parts.scheme not in ("http", "https") or not host:
+        return False
+    return any(host == h or (h.startswith(".") and host.endswith(h)) for h in JOB_CALLBACK_HOSTS)
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    # A redirect could point a callback at a host outside JOB_CALLBACK_HOSTS.
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+_callback_opener = urllib.request.build_opener(_NoRedirect)
+
+def post_callback(url: str, payload: dict):
+    if not callback_allowed(url):
+        raise ValueError(f"callback host not allowed: {url}")
+    req = urllib.request.Request(
+        url,
+        data=json.dumps(payload).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+        method="POST",
+    )
+    with _callback_opener.open(req, timeout=JOB_CALLBACK_TIMEOUT) as resp:
+        resp.read()
+
+class JobQueue:
+    def __init__(self, store, workers: int):
+        self.store = store
+        self.workers = workers
+        self._queue = None
+        self._tasks = []
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        for job_id in await asyncio.to_thread(self.store.queued):
+            self._queue.put_nowait(job_id)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._requeue_stale()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, job: dict, content: ExportContent):
+        await asyncio.to_thread(self.store.purge, time.time() - JOB_TTL)
+        await asyncio.to_thread(self.store.create, job, content)
+        self._queue.put_nowait(job["id"])
+
+    async def _requeue_stale(self):
+        # Jobs left running by a worker that was killed (or by this one
+        # before a restart) are picked up again once their lease expires.
+        while True:
+            for job_id in await asyncio.to_thread(self.store.requeue_stale, time.time() - JOB_LEASE):
+                logger.warning("job %s lease expired, requeued", job_id)
+                self._queue.put_nowait(job_id)
+            await asyncio.sleep(JOB_LEASE / 2)
+
+    async def _renew_lease(self, job_id: str):
+        while True:
+            await asyncio.sleep(JOB_LEASE / 3)
+            await asyncio.to_thread(self.store.touch, job_id)
+
+    async def _worker(self):
+        while True:
+            job_id = await self._queue.get()
+            try:
+                await self._run(job_id)
+            except Exception:
+                logger.exception("job %s failed", job_id)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job_id: str):
+        content = await asyncio.to_thread(self.store.claim, job_id)
+        if content is None:
+            return
+        job = await asyncio.to_thread(self.store.get, job_id)
+        lease = asyncio.create_task(self._renew_lease(job_id))
+        try:
+            data = await get_or_render(job["type"], job["title"], content, job["tenant"], shed=False)
+        except asyncio.CancelledError:
+            # Shutting down mid-render: hand the job back so the next start
+            # (or another worker sharing the store) runs it.
+            self.store.release(job_id)
+            raise
+        except Exception as exc:
+            await asyncio.to_thread(self.store.finish, job_id, "failed", error=f"{type(exc).__name__}: {exc}")
+        else:
+            await asyncio.to_thread(self.store.finish, job_id, "done", result=data)
+        finally:
+            lease.cancel()
+        if job["callback_url"]:
+            job = await asyncio.to_thread(self.store.get, job_id)
+            try:
+                await asyncio.to_thread(post_callback, job["callback_url"], job_status(job))
+            except Exception:
+                logger.warning("callback for job %s to %s failed", job_id, job["callback_url"], exc_info=True)
+
+    def stats(self) -> dict:
+        return {
+            "backend": "sqlite" if isinstance(self.store, SqliteJobStore) else "memory",
+            "workers": self.workers,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+        }
+
+job_queue = JobQueue(SqliteJobStore(JOBS_DB) if JOBS_DB else MemoryJobStore(), JOB_WORKERS)
+
+async def read_export_request(request: Request):
+    start = time.perf_counter()
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    if content_type in NDJSON_MEDIA_TYPES:
+        with traced("ndjson.read", phase="parse"):
+            body, content = await read_ndjson_export(request)
     else:
+        body = await read_json(request)
+        if not isinstance(body, dict):
+            raise HTTPException(status_code=400, detail="Body must be a JSON object")
+        content = body.get("content") or ""
+        if not isinstance(content, str):
+            raise HTTPException(status_code=400, detail="content must be a string")
+        content = ExportContent(content)
+    apply_content_options(content, read_content_options(body))
+    export_type = "multi" if body.get("types") is not None else (body.get("type") or "").lower()
+    if export_type in EXPORT_TYPES or export_type == "multi":
+        PHASE_SECONDS.observe(time.perf_counter() - start, type=export_type, phase="parse")
+    return body, content
+
+@app.post("/api/generate")
+async def generate(request: Request):
+    tenant = check_auth(request)
+    profile = requested_profile(request)
+
+    body, content = await read_export_request(request)
+    title = read_title(body)
+
+    types = body.get("types")
+    if types is not None:
+        if not isinstance(types, list) or not types:
+            raise HTTPException(status_code=400, detail="types must be a non-empty list")
+        types = list(dict.fromkeys((t or "").lower() for t in types))
+        if any(t not in EXPORT_TYPES for t in types):
+            raise HTTPException(status_code=400, detail="Unsupported export type")
+        if RENDER_POOL == "process" and ("pdf" in types or "docx" in types):
+            # Each process gets its own pickled copy, so derive the paragraph
+            # view here once instead of in every worker.
+            await asyncio.to_thread(lambda: content.paragraphs)
+        items = [{"type": t, "title": title, "content": content, "tenant": tenant} for t in types]
+        return bundle_response(items, body)
+
+    export_type = (body.get("type") or "").lower()
+    if export_type not in EXPORT_TYPES:
         raise HTTPException(status_code=400, detail="Unsupported export type")
 
+    media, filename = EXPORT_TYPES[export_type]
+    key = await export_cache_key(export_type, title, content)
+    etag = f'"{key}"'
     headers = {
-        "Content-Disposition": f'inline; filename="{filename}"'
+        "Content-Disposition": f'inline; filename="{filename}"',
+        "ETag": etag,
+    }
+
+    if profile:
+        data, profile_id = await render_profiled(key, export_type, title, content, tenant, profile)
+        headers["X-Cache"] = "BYPASS"
+        headers["X-Profile-Id"] = profile_id
+        headers["X-Profile-Url"] = f"/debug/profiles/{profile_id}"
+        return Response(content=data, media_type=media, headers=headers)
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+
+    data = render_cache.get(key)
+    if data is not None:
+        headers["X-Cache"] = "HIT"
+        return Response(content=data, media_type=media, headers=headers)
+    if disk_cache is not None:
+        f = disk_cache.open(key)
+        if f is not None:
+            headers["X-Cache"] = "HIT-DISK"
+            headers["Content-Length"] = str(os.fstat(f.fileno()).st_size)
+            return StreamingResponse(iter_file(f), media_type=media, headers=headers)
+    headers["X-Cache"] = "MISS"
+
+    if (export_type == "csv" and (body.get("stream") or content.size >= CSV_STREAM_THRESHOLD)
+            or export_type == "pdf" and content.pdf_mode == "stream"):
+        render_pool.check_admission(tenant)
+        return StreamingResponse(
+            stream_and_store(key, export_type, title, content, tenant), media_type=media, headers=headers,
+        )
+
+    data = await render_and_store(key, export_type, title, content, tenant)
+
+    return Response(content=data, media_type=media, headers=headers)
+
+@app.post("/api/generate/batch")
+async def generate_batch(request: Request):
+    tenant = check_auth(request)
+
+    body = await read_json(request)
+    if isinstance(body, list):
+        body = {"items": body}
+    items = await parse_batch_items(body.get("items"), tenant)
+    return bundle_response(items, body)
+
+@app.post("/api/jobs")
+async def create_job(request: Request):
+    tenant = check_auth(request)
+
+    body, content = await read_export_request(request)
+    export_type = (body.get("type") or "").lower()
+    if export_type not in EXPORT_TYPES:
+        raise HTTPException(status_code=400, detail="Unsupported export type")
+    title = read_title(body)
+    if JOB_MAX_QUEUED and job_queue.stats()["queued"] >= JOB_MAX_QUEUED:
+        raise Overloaded(503, "job_queue_full", "Job queue is full")
+    callback_url = body.get("callback_url") or None
+    if callback_url is not None:
+        if not isinstance(callback_url, str) or not callback_url.startswith(("http://", "https://")):
+            raise HTTPException(status_code=400, detail="callback_url must be an http(s) URL")
+        if not callback_allowed(callback_url):
+            raise HTTPException(status_code=400, detail="callback_url host is not in JOB_CALLBACK_HOSTS")
+
+    now = time.time()
+    job = {
+        "id": uuid.uuid4().hex,
+        "status": "queued",
+        "tenant": tenant,
+        "type": export_type,
+        "title": title,
+        "callback_url": callback_url,
+        "created": now,
+        "updated": now,
+        "error": None,
+        "size": None,
     }
+    await job_queue.submit(job, content)
+    return JSONResponse(job_status(job), status_code=202)
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str, request: Request):
+    tenant = check_auth(request)
+
+    job = await asyncio.to_thread(job_queue.store.get, job_id)
+    if job is None or job["tenant"] != tenant:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job_status(job)
 
+@app.get("/api/jobs/{job_id}/result")
+async def get_job_result(job_id: str, request: Request):
+    tenant = check_auth(request)
+
+    job = await asyncio.to_thread(job_queue.store.get, job_id)
+    if job is None or job["tenant"] != tenant:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job["status"] != "done":
+        raise HTTPException(status_code=409, detail=f"Job is {job['status']}")
+    data = await asyncio.to_thread(job_queue.store.result, job_id)
+    media, filename = EXPORT_TYPES[job["type"]]
+    headers = {"Content-Disposition": f'inline; filename="{filename}"'}
     return Response(content=data, media_type=media, headers=headers)
 
+@app.get("/debug/traces")
+async def debug_traces(request: Request, limit: int = 50):
+    # The ring holds every tenant's requests, so like /debug/profiles this
+    # is for operators only.
+    check_admin(request)
+
+    traces = list(trace_ring)[-limit:] if limit > 0 else []
+    traces.reverse()
+    return {"sinks": TRACE_SINKS, "traces": traces}
+
+@app.get("/debug/tenants")
+async def debug_tenants(request: Request):
+    # Tenant names come from PY_WORKER_KEYS, so the public health check
+    # only reports how many tenants have renders in flight.
+    check_admin(request)
+
+    return {"tenants": render_pool.tenant_stats()}
+
+@app.get("/debug/profiles")
+async def debug_profiles(request: Request):
+    check_admin(request)
+
+    return {
+        "profiles": [
+            {k: v for k, v in profile.items() if k not in ("text", "pstats")}
+            for profile in reversed(profile_store.values())
+        ]
+    }
+
+@app.get("/debug/profiles/{profile_id}")
+async def debug_profile(profile_id: str, request: Request, format: str = "text"):
+    check_admin(request)
+
+    profile = profile_store.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    if format == "pstats":
+        if profile["pstats"] is None:
+            raise HTTPException(status_code=400, detail="pstats output is only available for cprofile profiles")
+        headers = {"Content-Disposition": f'attachment; filename="{profile_id}.pstats"'}
+        return Response(content=profile["pstats"], media_type="application/octet-stream", headers=headers)
+    if format != "text":
+        raise HTTPException(status_code=400, detail="format must be text or pstats")
+    return PlainTextResponse(profile["text"])
@@ -0,0 +1,186 @@
+"""Benchmark generate_pdf / generate_docx / generate_csv over synthetic corpora.
+
+    python bench/bench_generators.py
+    python bench/bench_generators.py --sizes 1KB,1MB,100MB --shapes short-lines --generators pdf
+    python bench/bench_generators.py --save-baseline bench/baseline.json
+    python bench/bench_generators.py --baseline bench/baseline.json --threshold 0.15
+
+Every case runs in its own subprocess so peak RSS belongs to that case alone.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import resource
+import subprocess
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SHAPES = ("short-lines", "long-paragraphs", "unicode")
+GENERATORS = ("pdf", "docx", "csv")
+UNITS = {"B": 1, "KB": 1 << 10, "MB": 1 << 20, "GB": 1 << 30}
+DEFAULT_SIZES = "1KB,10KB,100KB,1MB"
+WORDS = "export report summary client meeting note action item follow up review quarterly budget".split()
+UNICODE_WORDS = "café naïve résumé Straße Ελλάδα Москва 東京 北京 서울 مرحبا שלום ☕ ✓ — … “quoted”".split()
+
+def parse_size(text: str) -> int:
+    text = text.strip().upper()
+    for unit in ("GB", "MB", "KB", "B"):
+        if text.endswith(unit):
+            return int(float(text[: -len(unit)]) * UNITS[unit])
+    return int(text)
+
+def format_size(size: int) -> str:
+    for unit in ("GB", "MB", "KB"):
+        if size >= UNITS[unit] and size % UNITS[unit] == 0:
+            return f"{size // UNITS[unit]}{unit}"
+    return f"{size}B"
+
+def make_corpus(shape: str, size: int, seed: int = 1) -> str:
+    rng = random.Random(seed)
+    words = UNICODE_WORDS + WORDS if shape == "unicode" else WORDS
+    line_words = (4, 12) if shape in ("short-lines", "unicode") else (400, 1200)
+    lines = []
+    total = 0
+    while total < size:
+        line = " ".join(rng.choice(words) for _ in range(rng.randint(*line_words)))
+        lines.append(line)
+        total += len(line) + 1
+    return "\n".join(lines)[:size]
+
+def run_case(generator: str, shape: str, size: int, repeat: int, allocations: bool) -> dict:
+    sys.path.insert(0, ROOT)
+    from api.app import generate_csv, generate_docx, generate_pdf
+
+    render = {
+        "pdf": lambda text: generate_pdf("Benchmark", text),
+        "docx": lambda text: generate_docx("Benchmark", text),
+        "csv": generate_csv,
+    }[generator]
+    text = make_corpus(shape, size)
+    render(make_corpus(shape, 256))
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    timings = []
+    output = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = len(render(text))
+        timings.append(time.perf_counter() - start)
+    rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result = {
+        "generator": generator,
+        "shape": shape,
+        "size": size,
+        "seconds": min(timings),
+        "mean_seconds": sum(timings) / len(timings),
+        "throughput_mb_s": size / (1 << 20) / min(timings),
+        "output_bytes": output,
+        # ru_maxrss is KiB on Linux and bytes on macOS.
+        "peak_rss_mb": rss_peak / (1 << 20 if sys.platform == "darwin" else 1 << 10),
+        "rss_growth_mb": (rss_peak - rss_before) / (1 << 20 if sys.platform == "darwin" else 1 << 10),
+    }
+    if allocations:
+        tracemalloc.start()
+        render(text)
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        result["alloc_peak_mb"] = peak / (1 << 20)
+        result["alloc_blocks"] = sum(stat.count for stat in snapshot.statistics("filename"))
+    return result
+
+def case_key(result: dict) -> str:
+    return f"{result['generator']}/{result['shape']}/{format_size(result['size'])}"
+
+def compare(results: list, baseline: dict, threshold: float) -> list:
+    regressions = []
+    for result in results:
+        base = baseline.get(case_key(result))
+        if base is None:
+            result["vs_baseline"] = None
+            continue
+        ratio = result["seconds"] / base["seconds"]
+        result["vs_baseline"] = ratio
+        if ratio > 1 + threshold:
+            regressions.append((case_key(result), ratio))
+    return regressions
+
+def print_table(results: list):
+    header = f"{'case':<32} {'seconds':>10} {'MB/s':>9} {'out KB':>10} {'peak RSS MB':>12} {'alloc MB':>9} {'vs base':>8}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        alloc = f"{r['alloc_peak_mb']:.1f}" if "alloc_peak_mb" in r else "-"
+        ratio = f"{r['vs_baseline']:.2f}x" if r.get("vs_baseline") else "-"
+        print(
+            f"{case_key(r):<32} {r['seconds']:>10.4f} {r['throughput_mb_s']:>9.2f} {r['output_bytes'] / 1024:>10.1f}"
+            f" {r['peak_rss_mb']:>12.1f} {alloc:>9} {ratio:>8}"
+        )
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help=f"comma-separated corpus sizes (default {DEFAULT_SIZES})")
+    parser.add_argument("--shapes", default=",".join(SHAPES), help="comma-separated corpus shapes")
+    parser.add_argument("--generators", default=",".join(GENERATORS), help="comma-separated generators")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per case; the fastest is reported")
+    parser.add_argument("--allocations", action="store_true", help="add a tracemalloc pass per case (slow)")
+    parser.add_argument("--baseline", help="baseline JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="slowdown ratio that counts as a regression")
+    parser.add_argument("--save-baseline", help="write results to this baseline JSON")
+    parser.add_argument("--json", help="write full results to this JSON file")
+    parser.add_argument("--run-case", nargs=3, metavar=("GENERATOR", "SHAPE", "SIZE"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        generator, shape, size = args.run_case
+        print(json.dumps(run_case(generator, shape, int(size), args.repeat, args.allocations)))
+        return 0
+
+    results = []
+    for generator in args.generators.split(","):
+        for shape in args.shapes.split(","):
+            if generator not in GENERATORS or shape not in SHAPES:
+                parser.error(f"unknown generator/shape {generator}/{shape}")
+            for size in map(parse_size, args.sizes.split(",")):
+                cmd = [sys.executable, os.path.abspath(__file__), "--run-case", generator, shape, str(size),
+                       "--repeat", str(args.repeat)]
+                if args.allocations:
+                    cmd.append("--allocations")
+                proc = subprocess.run(cmd, capture_output=True, text=True)
+                if proc.returncode != 0:
+                    print(proc.stderr, file=sys.stderr)
+                    return proc.returncode
+                results.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+                print(f"  {case_key(results[-1])}: {results[-1]['seconds']:.4f}s", file=sys.stderr)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f)["cases"], args.threshold)
+    print_table(results)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    if args.save_baseline:
+        import reportlab
+        import docx
+        baseline = {
+            "python": sys.version.split()[0],
+            "reportlab": reportlab.Version,
+            "python-docx": docx.__version__,
+            "cases": {case_key(r): r for r in results},
+        }
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) over {args.threshold:.0%}:")
+        for key, ratio in regressions:
+            print(f"  {key}: {ratio:.2f}x baseline")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
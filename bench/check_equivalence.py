@@ -0,0 +1,154 @@
+"""Check the hand-written writers against the library paths they replace.
+
+    python bench/check_equivalence.py
+    python bench/check_equivalence.py --cases 300 --seed 7
+    python bench/check_equivalence.py --case 42 --failures /tmp/eq
+
+Over a seeded corpus (long and split words, non-WinAnsi characters, odd
+whitespace, "<"/"&", documents long enough to split across pages):
+
+  pdf-fast    build_pdf_fast() bytes == platypus bytes
+  pdf-stream  iter_pdf_stream() page content streams == fast-path page content streams
+  docx-text   stream_docx() bytes == python-docx Document bytes (or both reject the input)
+  docx-md     the same for markdown content
+
+Run it after upgrading reportlab or python-docx. Exits 1 on any difference;
+with --failures, each failing case's title, content and outputs are saved
+there.
+"""
+import os
+import re
+import sys
+import zlib
+import base64
+import random
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import api.app as app
+
+CHECKS = ("pdf-fast", "pdf-stream", "docx-text", "docx-md")
+ASCII = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789.,;:!?()[]{}\\/'\"-_=+*#%$@^~`|<>&;"
+# Latin-1 and WinAnsi-only glyphs, characters Helvetica cannot encode
+# (substitution fonts), and whitespace str.split() and Paragraph treat
+# differently.
+EXTRA = "éüñ€—•中Ж\U0001F600　  \x0b\x0c\x1c\x1f\x85\r"
+TITLES = ("Solace Export", "A < B & C", "T " * 60, "x" * 150, "Résumé — 中文")
+MARKDOWN_PIECES = (
+    "# h", "## h2 **b**", "###### six", "- item *i*", "  - sub", "    - subsub", "      - clamp", "1. n", "2) m",
+    "```", "~~~", "code\tline", "| a | b |", "|---|---|", "| c |", "| x | y | z |", "plain `c` text",
+    "__u__ and _v_", "a\\*b", "***", "", "", "tab\there", "x < y & z", "| only", "  indented", "é中😀",
+)
+_PDF_STREAM = re.compile(rb"\bobj\s*<<((?:(?!\bobj\b).)*?)>>\s*stream\r?\n", re.S)
+_PDF_LENGTH = re.compile(rb"/Length (\d+)")
+# What the canvas writes around every page (its initial graphics/text state
+# and a trailing space), which the stream writer leaves out.
+_CANVAS_PAGE_PREAMBLE = b"1 0 0 1 0 0 cm  BT /F1 12 Tf 14.4 TL ET\n"
+
+def make_word(rng: random.Random) -> str:
+    alphabet = ASCII + EXTRA if rng.random() < 0.3 else ASCII
+    length = rng.choice((40, 120, 300)) if rng.random() < 0.05 else rng.randint(1, 9)
+    return "".join(rng.choice(alphabet) for _ in range(length))
+
+def make_text(rng: random.Random) -> str:
+    words = rng.choice((1, 5, 50, 300))
+    paragraphs = []
+    for _ in range(rng.choice((0, 1, 3, 30, 150))):
+        sep = rng.choice((" ", "  ", "\t", " \t ")) if rng.random() < 0.2 else " "
+        paragraphs.append(sep.join(make_word(rng) for _ in range(rng.randint(1, words))))
+    return "\n".join(paragraphs)
+
+def make_markdown(rng: random.Random) -> str:
+    return "\n".join(rng.choice(MARKDOWN_PIECES) for _ in range(rng.randint(0, 80)))
+
+def page_streams(pdf: bytes) -> list:
+    streams = []
+    for match in _PDF_STREAM.finditer(pdf):
+        params = match.group(1)
+        data = pdf[match.end():match.end() + int(_PDF_LENGTH.search(params).group(1))]
+        if b"/ASCII85Decode" in params:
+            data = base64.a85decode(data.strip(), adobe=True)
+        if b"/FlateDecode" in params:
+            data = zlib.decompress(data)
+        if b" Tf" in data:
+            if data.startswith(_CANVAS_PAGE_PREAMBLE):
+                data = data[len(_CANVAS_PAGE_PREAMBLE):]
+            streams.append(data.rstrip())
+    return streams
+
+def render_docx(writer: str, title: str, content):
+    app.DOCX_WRITER = writer
+    try:
+        return app.build_docx(title, content)
+    except ValueError as e:
+        return f"ValueError: {e}".encode()
+
+def check_case(seed: int, case: int, checks: tuple) -> dict:
+    rng = random.Random(f"{seed}:{case}")
+    title = rng.choice(TITLES)
+    text = make_text(rng)
+    failures = {}
+    content = app.ExportContent(text)
+    if ("pdf-fast" in checks or "pdf-stream" in checks) and app.pdf_fast_path_ok(title, content.paragraphs):
+        content.pdf_mode = "fast"
+        fast = app.build_pdf(title, content)
+        if "pdf-fast" in checks:
+            content.pdf_mode = "platypus"
+            platypus = app.build_pdf(title, content)
+            if fast != platypus:
+                failures["pdf-fast"] = (title, text, fast, platypus)
+        if "pdf-stream" in checks:
+            streamed = b"".join(app.iter_pdf_stream(title, content))
+            if page_streams(streamed) != page_streams(fast):
+                failures["pdf-stream"] = (title, text, streamed, fast)
+    if "docx-text" in checks:
+        stream, document = (render_docx(w, title, app.ExportContent(text)) for w in ("stream", "document"))
+        if stream != document:
+            failures["docx-text"] = (title, text, stream, document)
+    if "docx-md" in checks:
+        markdown = make_markdown(rng)
+        stream, document = (
+            render_docx(w, title, app.ExportContent(markdown, format="markdown")) for w in ("stream", "document")
+        )
+        if stream != document:
+            failures["docx-md"] = (title, markdown, stream, document)
+    return failures
+
+def save_failure(directory: str, case: int, check: str, failure: tuple):
+    title, text, got, expected = failure
+    os.makedirs(directory, exist_ok=True)
+    stem = os.path.join(directory, f"{case:04d}-{check}")
+    with open(stem + ".txt", "w", encoding="utf-8", errors="surrogatepass") as f:
+        f.write(title + "\n=====\n" + text)
+    with open(stem + ".got", "wb") as f:
+        f.write(got)
+    with open(stem + ".expected", "wb") as f:
+        f.write(expected)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cases", type=int, default=100, help="number of seeded cases (default 100)")
+    parser.add_argument("--seed", type=int, default=1, help="corpus seed")
+    parser.add_argument("--case", type=int, help="run only this case number")
+    parser.add_argument("--checks", default=",".join(CHECKS), help="comma-separated checks to run")
+    parser.add_argument("--failures", help="directory to save failing cases to")
+    args = parser.parse_args()
+
+    checks = tuple(args.checks.split(","))
+    if any(check not in CHECKS for check in checks):
+        parser.error(f"checks must be among {', '.join(CHECKS)}")
+    cases = [args.case] if args.case is not None else range(args.cases)
+    failed = 0
+    for case in cases:
+        for check, failure in check_case(args.seed, case, checks).items():
+            failed += 1
+            print(f"case {case}: {check} differs", file=sys.stderr)
+            if args.failures:
+                save_failure(args.failures, case, check, failure)
+    print(f"{len(cases)} case(s), {failed} difference(s)")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,293 @@
+"""HTTP load test for /api/generate with a mixed export workload.
+
+    python bench/loadtest.py                                  # in-process, no server needed
+    python bench/loadtest.py --uvicorn --concurrency 32       # spawn a local uvicorn
+    python bench/loadtest.py --url http://127.0.0.1:8000 --key $PY_WORKER_KEY
+    python bench/loadtest.py --mix pdf=6,docx=3,csv=1 --content-size 1KB-64KB --duration 30
+
+--repeat-ratio sends previously used payloads again to exercise the render
+cache; --env KEY=VALUE (repeatable) configures the app for in-process and
+--uvicorn runs, e.g. --env RENDER_POOL=process.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import threading
+import subprocess
+import http.client
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+
+from bench_generators import SHAPES, make_corpus, parse_size
+
+class Workload:
+    def __init__(self, mix: dict, size_range: tuple, repeat_ratio: float, seed: int):
+        self.types = list(mix)
+        self.weights = [mix[t] for t in self.types]
+        self.size_range = size_range
+        self.repeat_ratio = repeat_ratio
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.sent = []
+        self.counter = 0
+
+    def next_request(self):
+        with self.lock:
+            if self.sent and self.rng.random() < self.repeat_ratio:
+                return self.rng.choice(self.sent)
+            self.counter += 1
+            export_type = self.rng.choices(self.types, self.weights)[0]
+            size = self.rng.randint(*self.size_range)
+            shape = self.rng.choice(SHAPES)
+            content = make_corpus(shape, size, seed=self.counter)
+            body = json.dumps({"type": export_type, "title": f"Load test {self.counter}", "content": content})
+            request = (export_type, body.encode("utf-8"))
+            if len(self.sent) < 1000:
+                self.sent.append(request)
+            return request
+
+class Results:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = []
+
+    def record(self, export_type: str, status: int, latency: float, nbytes: int):
+        with self.lock:
+            self.samples.append((export_type, status, latency, nbytes))
+
+def percentile(sorted_values: list, q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(q * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def summarize(results: Results, elapsed: float) -> dict:
+    groups = {"all": results.samples}
+    for sample in results.samples:
+        groups.setdefault(sample[0], []).append(sample)
+    summary = {"elapsed_s": elapsed, "groups": {}}
+    for name, samples in groups.items():
+        latencies = sorted(s[2] for s in samples)
+        statuses = {}
+        for s in samples:
+            statuses[str(s[1])] = statuses.get(str(s[1]), 0) + 1
+        errors = sum(1 for s in samples if not 200 <= s[1] < 400)
+        summary["groups"][name] = {
+            "requests": len(samples),
+            "rps": len(samples) / elapsed if elapsed else 0.0,
+            "p50_ms": percentile(latencies, 0.50) * 1000,
+            "p95_ms": percentile(latencies, 0.95) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+            "max_ms": (latencies[-1] if latencies else 0.0) * 1000,
+            "error_rate": errors / len(samples) if samples else 0.0,
+            "mb_out": sum(s[3] for s in samples) / (1 << 20),
+            "statuses": statuses,
+        }
+    return summary
+
+def print_summary(summary: dict):
+    header = f"{'type':<6} {'reqs':>7} {'rps':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9} {'err %':>7} {'MB out':>8}  statuses"
+    print(f"elapsed {summary['elapsed_s']:.1f}s")
+    print(header)
+    print("-" * len(header))
+    for name, g in summary["groups"].items():
+        print(
+            f"{name:<6} {g['requests']:>7} {g['rps']:>8.1f} {g['p50_ms']:>9.1f} {g['p95_ms']:>9.1f} {g['p99_ms']:>9.1f}"
+            f" {g['max_ms']:>9.1f} {g['error_rate'] * 100:>7.2f} {g['mb_out']:>8.1f}  {g['statuses']}"
+        )
+
+async def asgi_post(app, path: str, headers: dict, body: bytes):
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers.items()],
+        "client": ("127.0.0.1", 0),
+        "server": ("127.0.0.1", 80),
+    }
+    done = asyncio.Event()
+    request_sent = False
+    status = 0
+    size = 0
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        await done.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal status, size
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        elif message["type"] == "http.response.body":
+            size += len(message.get("body", b""))
+            if not message.get("more_body"):
+                done.set()
+
+    await app(scope, receive, send)
+    done.set()
+    return status, size
+
+async def run_in_process(args, workload: Workload, results: Results) -> float:
+    for item in args.env:
+        key, _, value = item.partition("=")
+        os.environ[key] = value
+    os.environ.setdefault("PY_WORKER_KEY", args.key)
+    sys.path.insert(0, ROOT)
+    from api.app import app
+
+    headers = {"authorization": f"Bearer {os.environ['PY_WORKER_KEY']}", "content-type": "application/json"}
+    deadline = time.monotonic() + args.duration
+    remaining = [args.requests]
+
+    def take() -> bool:
+        if args.requests:
+            remaining[0] -= 1
+            return remaining[0] >= 0
+        return time.monotonic() < deadline
+
+    async def worker():
+        while take():
+            export_type, body = workload.next_request()
+            start = time.perf_counter()
+            try:
+                status, size = await asgi_post(app, "/api/generate", headers, body)
+            except Exception:
+                status, size = 599, 0
+            results.record(export_type, status, time.perf_counter() - start, size)
+
+    async with app.router.lifespan_context(app):
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        return time.perf_counter() - start
+
+def run_over_http(args, url: str, workload: Workload, results: Results) -> float:
+    parsed = urllib.parse.urlsplit(url)
+    path = (parsed.path.rstrip("/") or "") + "/api/generate"
+    headers = {"Authorization": f"Bearer {args.key}", "Content-Type": "application/json"}
+    deadline = time.monotonic() + args.duration
+    lock = threading.Lock()
+    remaining = [args.requests]
+
+    def take() -> bool:
+        if args.requests:
+            with lock:
+                remaining[0] -= 1
+                return remaining[0] >= 0
+        return time.monotonic() < deadline
+
+    def worker():
+        conn_cls = http.client.HTTPSConnection if parsed.scheme == "https" else http.client.HTTPConnection
+        conn = conn_cls(parsed.hostname, parsed.port, timeout=args.timeout)
+        while take():
+            export_type, body = workload.next_request()
+            start = time.perf_counter()
+            try:
+                conn.request("POST", path, body=body, headers=headers)
+                resp = conn.getresponse()
+                status, size = resp.status, len(resp.read())
+            except Exception:
+                conn.close()
+                conn = conn_cls(parsed.hostname, parsed.port, timeout=args.timeout)
+                status, size = 599, 0
+            results.record(export_type, status, time.perf_counter() - start, size)
+        conn.close()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for future in [pool.submit(worker) for _ in range(args.concurrency)]:
+            future.result()
+    return time.perf_counter() - start
+
+def start_uvicorn(args):
+    env = dict(os.environ)
+    env.setdefault("PY_WORKER_KEY", args.key)
+    for item in args.env:
+        key, _, value = item.partition("=")
+        env[key] = value
+    args.key = env["PY_WORKER_KEY"]
+    cmd = [sys.executable, "-m", "uvicorn", "api.app:app", "--port", str(args.port), "--log-level", "warning",
+           "--workers", str(args.uvicorn_workers)]
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=env)
+    url = f"http://127.0.0.1:{args.port}"
+    for _ in range(100):
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", args.port, timeout=1)
+            conn.request("GET", "/")
+            if conn.getresponse().status == 200:
+                return proc, url
+        except OSError:
+            time.sleep(0.1)
+    proc.terminate()
+    raise SystemExit("uvicorn did not start")
+
+def parse_mix(text: str) -> dict:
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="target a running server instead of the in-process app")
+    parser.add_argument("--uvicorn", action="store_true", help="start a local uvicorn and target it")
+    parser.add_argument("--uvicorn-workers", type=int, default=1)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--key", default=os.getenv("PY_WORKER_KEY", "loadtest"), help="bearer key")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="app environment override")
+    parser.add_argument("--mix", default="pdf=5,docx=3,csv=2", help="weighted export types")
+    parser.add_argument("--content-size", default="512B-16KB", help="content size or MIN-MAX range")
+    parser.add_argument("--repeat-ratio", type=float, default=0.0, help="fraction of requests reusing a payload")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to run (ignored with --requests)")
+    parser.add_argument("--requests", type=int, default=0, help="stop after this many requests")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="write the summary to this JSON file")
+    args = parser.parse_args()
+
+    low, _, high = args.content_size.partition("-")
+    size_range = (parse_size(low), parse_size(high or low))
+    workload = Workload(parse_mix(args.mix), size_range, args.repeat_ratio, args.seed)
+    results = Results()
+
+    proc = None
+    try:
+        if args.uvicorn:
+            proc, url = start_uvicorn(args)
+            elapsed = run_over_http(args, url, workload, results)
+        elif args.url:
+            elapsed = run_over_http(args, args.url, workload, results)
+        else:
+            elapsed = asyncio.run(run_in_process(args, workload, results))
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+
+    summary = summarize(results, elapsed)
+    print_summary(summary)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+    return 0 if summary["groups"]["all"]["error_rate"] == 0 else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
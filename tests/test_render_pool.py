@@ -0,0 +1,176 @@
+import os
+import sys
+import time
+import asyncio
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from api.app import ExportContent, Overloaded, RenderPool, SqliteJobStore
+
+FAST, SLOW = 1, 100
+
+def blocking_job(gate: threading.Event, started: list, name: str):
+    started.append(name)
+    gate.wait(5)
+    return name
+
+def make_pool(**kwargs) -> RenderPool:
+    options = dict(kind="thread", workers=4, max_concurrency=2, fast_lane_cost=10)
+    options.update(kwargs)
+    return RenderPool(**options)
+
+async def settle():
+    for _ in range(20):
+        await asyncio.sleep(0.01)
+
+def test_slow_job_waits_while_fast_job_runs():
+    async def scenario():
+        pool = make_pool(fast_lane_slots=1)
+        gate, started = threading.Event(), []
+        slow1 = asyncio.create_task(pool.run(blocking_job, gate, started, "slow1", cost=SLOW))
+        await settle()
+        slow2 = asyncio.create_task(pool.run(blocking_job, gate, started, "slow2", cost=SLOW))
+        fast = asyncio.create_task(pool.run(blocking_job, gate, started, "fast", cost=FAST))
+        await settle()
+        # One of the two slots is reserved for the fast lane.
+        assert started == ["slow1", "fast"]
+        assert pool.stats()["slow_lane"]["queued"] == 1
+        gate.set()
+        assert await asyncio.gather(slow1, slow2, fast) == ["slow1", "slow2", "fast"]
+        await settle()
+        assert pool.in_flight == 0 and pool.slow_in_flight == 0
+        pool.shutdown()
+
+    asyncio.run(scenario())
+
+def test_tenant_queue_limit_is_429():
+    async def scenario():
+        pool = make_pool(tenant_concurrency=1, tenant_max_queued=1)
+        gate, started = threading.Event(), []
+        running = asyncio.create_task(pool.run(blocking_job, gate, started, "a1", tenant="a"))
+        await settle()
+        queued = asyncio.create_task(pool.run(blocking_job, gate, started, "a2", tenant="a"))
+        await settle()
+        with pytest.raises(Overloaded) as excinfo:
+            await pool.run(blocking_job, gate, started, "a3", tenant="a")
+        assert excinfo.value.status_code == 429
+        # Other tenants are not held back by tenant a's limit.
+        assert await asyncio.wait_for(pool.run(len, "b", tenant="b"), 1) == 1
+        gate.set()
+        assert await asyncio.gather(running, queued) == ["a1", "a2"]
+        pool.shutdown()
+
+    asyncio.run(scenario())
+
+def test_full_queue_is_503():
+    async def scenario():
+        pool = make_pool(max_concurrency=1, max_queued=1)
+        gate, started = threading.Event(), []
+        running = asyncio.create_task(pool.run(blocking_job, gate, started, "a", tenant="a"))
+        await settle()
+        queued = asyncio.create_task(pool.run(blocking_job, gate, started, "b", tenant="b"))
+        await settle()
+        with pytest.raises(Overloaded) as excinfo:
+            await pool.run(blocking_job, gate, started, "c", tenant="c")
+        assert excinfo.value.status_code == 503
+        with pytest.raises(Overloaded):
+            pool.check_admission("d", n=2)
+        # shed=False (bundles, jobs) waits instead of failing.
+        unshed = asyncio.create_task(pool.run(blocking_job, gate, started, "e", tenant="e", shed=False))
+        await settle()
+        gate.set()
+        assert await asyncio.gather(running, queued, unshed) == ["a", "b", "e"]
+        pool.shutdown()
+
+    asyncio.run(scenario())
+
+def test_cancelled_waiter_gives_back_its_place():
+    async def scenario():
+        pool = make_pool(max_concurrency=1)
+        gate, started = threading.Event(), []
+        running = asyncio.create_task(pool.run(blocking_job, gate, started, "running", tenant="a"))
+        await settle()
+        waiter = asyncio.create_task(pool.run(blocking_job, gate, started, "cancelled", tenant="b"))
+        await settle()
+        assert pool.queued == 1
+        waiter.cancel()
+        await settle()
+        assert pool.queued == 0 and pool.tenant_queued == {}
+        gate.set()
+        assert await running == "running"
+        await settle()
+        assert pool.in_flight == 0 and pool.tenant_in_flight == {}
+        assert "cancelled" not in started
+        # The slot is free again for the next job.
+        assert await asyncio.wait_for(pool.run(len, "ok"), 1) == 2
+        pool.shutdown()
+
+    asyncio.run(scenario())
+
+def test_cancelled_request_keeps_slot_until_render_finishes():
+    async def scenario():
+        pool = make_pool(max_concurrency=1)
+        gate, started = threading.Event(), []
+        request = asyncio.create_task(pool.run(blocking_job, gate, started, "render"))
+        await settle()
+        request.cancel()
+        await settle()
+        # The render is still running on the executor, so its slot is held.
+        assert pool.in_flight == 1
+        gate.set()
+        await settle()
+        assert pool.in_flight == 0
+        pool.shutdown()
+
+    asyncio.run(scenario())
+
+def test_stream_releases_slot_when_closed_early():
+    def chunks():
+        for i in range(1000):
+            yield b"%d" % i
+
+    async def scenario():
+        pool = make_pool(max_concurrency=1)
+        stream = pool.stream(chunks)
+        assert await stream.__anext__() == b"0"
+        assert pool.in_flight == 1
+        await stream.aclose()
+        await settle()
+        assert pool.in_flight == 0
+        pool.shutdown()
+
+    asyncio.run(scenario())
+
+def make_job(job_id: str, updated: float) -> dict:
+    return {
+        "id": job_id, "status": "queued", "tenant": "default", "type": "csv", "title": "T",
+        "callback_url": None, "created": updated, "updated": updated, "error": None, "size": None,
+    }
+
+def test_sqlite_store_release_and_requeue_stale(tmp_path):
+    store = SqliteJobStore(str(tmp_path / "jobs.db"))
+    for job_id in ("stale", "live", "queued"):
+        store.create(make_job(job_id, time.time()), ExportContent("a\nb"))
+    assert store.claim("stale").text == "a\nb"
+    cutoff = time.time()
+    time.sleep(0.01)
+    assert store.claim("live") is not None
+    assert store.claim("live") is None
+
+    assert store.requeue_stale(cutoff) == ["stale"]
+    assert store.get("stale")["status"] == "queued"
+    assert store.get("live")["status"] == "running"
+    assert store.requeue_stale(cutoff) == []
+
+    store.touch("live")
+    store.release("live")
+    assert store.get("live")["status"] == "queued"
+    # release() only hands back running jobs.
+    store.finish("queued", "done", result=b"x")
+    store.release("queued")
+    assert store.get("queued")["status"] == "done"
+    assert store.queued() == ["stale", "live"]
+    assert store.claim("stale").text == "a\nb"